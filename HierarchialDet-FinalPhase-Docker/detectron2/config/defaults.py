@@ -117,10 +117,13 @@ _C.DATALOADER.NUM_WORKERS = 4
 # is compatible. This groups portrait images together, and landscape images
 # are not batched with portrait images.
 _C.DATALOADER.ASPECT_RATIO_GROUPING = True
-# Options: TrainingSampler, RepeatFactorTrainingSampler
+# Options: TrainingSampler, RepeatFactorTrainingSampler, HierarchyGroupedTrainingSampler
 _C.DATALOADER.SAMPLER_TRAIN = "TrainingSampler"
-# Repeat threshold for RepeatFactorTrainingSampler
+# Repeat threshold for RepeatFactorTrainingSampler and HierarchyGroupedTrainingSampler
 _C.DATALOADER.REPEAT_THRESHOLD = 0.0
+# Relative frequency of the batches of images labeled with 1, 2, ... hierarchy levels
+# for HierarchyGroupedTrainingSampler. Empty means in proportion to the number of images.
+_C.DATALOADER.HIERARCHY_GROUP_RATIOS = []
 # Tf True, when working on datasets that have instance annotations, the
 # training dataloader will filter out images without associated annotations
 _C.DATALOADER.FILTER_EMPTY_ANNOTATIONS = True
@@ -22,6 +22,7 @@ from .common import AspectRatioGroupedDataset, DatasetFromList, MapDataset, ToIt
 from .dataset_mapper import DatasetMapper
 from .detection_utils import check_metadata_consistency
 from .samplers import (
+    HierarchyGroupedTrainingSampler,
     InferenceSampler,
     RandomSubsetTrainingSampler,
     RepeatFactorTrainingSampler,
@@ -378,6 +379,21 @@ def _train_loader_from_config(cfg, mapper=None, *, dataset=None, sampler=None):
                     dataset, cfg.DATALOADER.REPEAT_THRESHOLD
                 )
                 sampler = RepeatFactorTrainingSampler(repeat_factors)
+            elif sampler_name == "HierarchyGroupedTrainingSampler":
+                repeat_factors = RepeatFactorTrainingSampler.repeat_factors_from_category_frequency(
+                    dataset, cfg.DATALOADER.REPEAT_THRESHOLD
+                )
+                groups = HierarchyGroupedTrainingSampler.label_completeness_groups(dataset)
+                # one block per batch of every dataloader worker, so that no batch mixes groups
+                block_size = cfg.SOLVER.IMS_PER_BATCH * max(cfg.DATALOADER.NUM_WORKERS, 1)
+                group_ratios = cfg.DATALOADER.HIERARCHY_GROUP_RATIOS
+                if len(group_ratios) > 0:
+                    group_ratios = {level: ratio for level, ratio in enumerate(group_ratios, 1)}
+                else:
+                    group_ratios = None
+                sampler = HierarchyGroupedTrainingSampler(
+                    repeat_factors, groups, block_size, group_ratios
+                )
             elif sampler_name == "RandomSubsetTrainingSampler":
                 sampler = RandomSubsetTrainingSampler(
                     len(dataset), cfg.DATALOADER.RANDOM_SUBSET_RATIO
@@ -1,5 +1,6 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
 from .distributed_sampler import (
+    HierarchyGroupedTrainingSampler,
     InferenceSampler,
     RandomSubsetTrainingSampler,
     RepeatFactorTrainingSampler,
@@ -14,4 +15,5 @@ __all__ = [
     "RandomSubsetTrainingSampler",
     "InferenceSampler",
     "RepeatFactorTrainingSampler",
+    "HierarchyGroupedTrainingSampler",
 ]
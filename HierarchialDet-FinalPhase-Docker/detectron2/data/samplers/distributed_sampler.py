@@ -242,6 +242,96 @@ class RepeatFactorTrainingSampler(Sampler):
                 yield from indices.tolist()
 
 
+class HierarchyGroupedTrainingSampler(RepeatFactorTrainingSampler):
+    """
+    Similar to RepeatFactorTrainingSampler, but the indices come in blocks of `block_size`
+    images that share the same group, e.g. the hierarchy levels labeled in an image
+    (see :meth:`label_completeness_groups`). Each block is drawn from a group chosen at
+    random with the given ratios.
+
+    With `block_size` equal to the total batch size times the number of dataloader workers,
+    every batch built by :func:`build_batch_data_loader` holds images of a single group.
+    With aspect ratio grouping, this also requires the images of a group to share the
+    same aspect ratio bucket.
+    """
+
+    def __init__(self, repeat_factors, groups, block_size, group_ratios=None, *, shuffle=True, seed=None):
+        """
+        Args:
+            repeat_factors (Tensor): a float vector, the repeat factor for each indice.
+            groups (Tensor): an int vector, the group of each indice.
+            block_size (int): the number of consecutive indices drawn from the same group.
+            group_ratios (dict[int, float] or None): the relative frequency of the blocks of
+                each group. If None, the groups are drawn in proportion to their number of
+                images (with repeats), as RepeatFactorTrainingSampler would sample them.
+            shuffle (bool): whether to shuffle the indices within each group or not
+            seed (int): the initial seed of the shuffle. Must be the same
+                across all workers. If None, will use a random seed shared
+                among workers (require synchronization among all workers).
+        """
+        super().__init__(repeat_factors, shuffle=shuffle, seed=seed)
+        assert block_size > 0
+        self._groups = torch.as_tensor(groups, dtype=torch.int64)
+        assert len(self._groups) == len(repeat_factors)
+        self._block_size = block_size
+
+        self._group_ids = sorted(set(self._groups.tolist()))
+        if group_ratios is None:
+            group_ratios = {g: float(repeat_factors[self._groups == g].sum()) for g in self._group_ids}
+        for g, ratio in group_ratios.items():
+            assert ratio == 0 or g in self._group_ids, "Group {} has no images.".format(g)
+        self._group_ratios = torch.tensor([float(group_ratios.get(g, 0.0)) for g in self._group_ids])
+        assert self._group_ratios.sum() > 0, "At least one group must have a positive ratio."
+        logger.info(
+            "Using HierarchyGroupedTrainingSampler with group ratios {}".format(
+                dict(zip(self._group_ids, self._group_ratios.tolist()))
+            )
+        )
+
+    @staticmethod
+    def label_completeness_groups(dataset_dicts, num_levels=3):
+        """
+        Group the images by the number of hierarchy levels they are labeled with, i.e.
+        the largest l such that every annotation has "category_id_1" ... "category_id_l".
+
+        Args:
+            dataset_dicts (list[dict]): annotations in Detectron2 dataset format.
+            num_levels (int): the number of hierarchy levels.
+
+        Returns:
+            torch.Tensor: the i-th element is the group of the dataset image at index i.
+        """
+        groups = []
+        for dataset_dict in dataset_dicts:
+            annos = dataset_dict["annotations"]
+            level = 0
+            while (
+                level < num_levels
+                and len(annos) > 0
+                and all("category_id_{}".format(level + 1) in ann for ann in annos)
+            ):
+                level += 1
+            groups.append(level)
+        return torch.tensor(groups, dtype=torch.int64)
+
+    def _infinite_group_indices(self, group, generator):
+        # an endless stream of the indices of one group, one (repeated) epoch after another
+        while True:
+            indices = self._get_epoch_indices(generator)
+            indices = indices[self._groups[indices] == group]
+            if self._shuffle:
+                indices = indices[torch.randperm(len(indices), generator=generator)]
+            yield from indices.tolist()
+
+    def _infinite_indices(self):
+        g = torch.Generator()
+        g.manual_seed(self._seed)
+        streams = [self._infinite_group_indices(group, g) for group in self._group_ids]
+        while True:
+            group = torch.multinomial(self._group_ratios, 1, generator=g).item()
+            yield from itertools.islice(streams[group], self._block_size)
+
+
 class InferenceSampler(Sampler):
     """
     Produce indices for inference across all workers.
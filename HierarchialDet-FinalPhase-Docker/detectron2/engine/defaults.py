@@ -16,14 +16,17 @@ import sys
 import weakref
 from collections import OrderedDict
 from typing import Optional
+import numpy as np
 import torch
 from fvcore.nn.precise_bn import get_bn_modules
 from omegaconf import OmegaConf
+from PIL import Image
 from torch.nn.parallel import DistributedDataParallel
 
 import detectron2.data.transforms as T
 from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.config import CfgNode, LazyConfig
+from detectron2.data import detection_utils as utils
 from detectron2.data import (
     MetadataCatalog,
     build_detection_test_loader,
@@ -293,7 +296,7 @@ class DefaultPredictor:
         )
 
         self.input_format = cfg.INPUT.FORMAT
-        assert self.input_format in ["RGB", "BGR"], self.input_format
+        assert self.input_format in ["RGB", "BGR", "L"], self.input_format
 
     def __call__(self, original_image):
         """
@@ -306,18 +309,60 @@ class DefaultPredictor:
                 See :doc:`/tutorials/models` for details about the format.
         """
         with torch.no_grad():  # https://github.com/sphinx-doc/sphinx/issues/4258
-            # Apply pre-processing to image.
-            if self.input_format == "RGB":
-                # whether the model expects BGR inputs or RGB
-                original_image = original_image[:, :, ::-1]
-            height, width = original_image.shape[:2]
-            image = self.aug.get_transform(original_image).apply_image(original_image)
-            image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
-
-            inputs = {"image": image, "height": height, "width": width}
+            inputs = self.preprocess(original_image)
             predictions = self.model([inputs],self.i)[0]
             return predictions
 
+    def predict_batch(self, original_images):
+        """
+        Args:
+            original_images (list[np.ndarray]): images of shape (H, W, C) (in BGR order).
+                They may have different sizes; the model pads them into one batch.
+
+        Returns:
+            list[dict]: the output of the model for each image, in input order.
+        """
+        inputs = [self.preprocess(original_image) for original_image in original_images]
+        return self.predict_inputs(inputs)
+
+    def predict_inputs(self, inputs):
+        """
+        Args:
+            inputs (list[dict]): images already converted by :meth:`preprocess`.
+
+        Returns:
+            list[dict]: the output of the model for each input, in input order.
+        """
+        with torch.no_grad():
+            return self.model(inputs, self.i)
+
+    def preprocess(self, original_image):
+        """
+        Apply the input format conversion and test-time resize to one image.
+
+        Returns:
+            dict: the model input for this image, in the format of :class:`DatasetMapper`.
+        """
+        if self.input_format == "L":
+            # grayscale images stay a single uint8 channel, the model normalizes them on its device
+            if original_image.ndim == 2:
+                original_image = original_image[:, :, None]
+            elif original_image.shape[2] != 1:
+                original_image = utils.convert_PIL_to_numpy(
+                    Image.fromarray(np.ascontiguousarray(original_image[:, :, ::-1])), "L"
+                )
+        elif self.input_format == "RGB":
+            # whether the model expects BGR inputs or RGB
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = self.aug.get_transform(original_image).apply_image(original_image)
+        if self.input_format == "L":
+            image = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
+        else:
+            image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+
+        return {"image": image, "height": height, "width": width}
+
 
 class DefaultTrainer(TrainerBase):
     """
@@ -25,16 +25,24 @@ def add_diffusiondet_config(cfg):
     cfg.MODEL.DiffusionDet.NUM_CLS = 1
     cfg.MODEL.DiffusionDet.NUM_REG = 3
     cfg.MODEL.DiffusionDet.NUM_HEADS = 6
+    # Predict the logits of all hierarchy levels with one Linear layer.
+    cfg.MODEL.DiffusionDet.FUSE_CLS_LOGITS = False
 
     # Dynamic Conv.
     cfg.MODEL.DiffusionDet.NUM_DYNAMIC = 2
     cfg.MODEL.DiffusionDet.DIM_DYNAMIC = 64
+    # If > 0, inference runs the dynamic convs on blocks of this many proposals, which bounds
+    # the memory of the per-proposal parameters to the block size. 0 processes all at once.
+    cfg.MODEL.DiffusionDet.DYNAMIC_CONV_CHUNK_SIZE = 0
 
     # Loss.
     cfg.MODEL.DiffusionDet.CLASS_WEIGHT = 2.0
     cfg.MODEL.DiffusionDet.GIOU_WEIGHT = 2.0
     cfg.MODEL.DiffusionDet.L1_WEIGHT = 5.0
     cfg.MODEL.DiffusionDet.DEEP_SUPERVISION = True
+    # Match once on this head (-1 is the final head) and reuse the assignment for every head.
+    cfg.MODEL.DiffusionDet.SHARED_ASSIGNMENT = False
+    cfg.MODEL.DiffusionDet.SHARED_ASSIGNMENT_HEAD = -1
     cfg.MODEL.DiffusionDet.NO_OBJECT_WEIGHT = 0.1
 
     # Focal Loss.
@@ -50,14 +58,36 @@ def add_diffusiondet_config(cfg):
     # Diffusion
     cfg.MODEL.DiffusionDet.SNR_SCALE = 2.0
     cfg.MODEL.DiffusionDet.SAMPLE_STEP = 1
+    # Number of independent noise chains sampled per image at inference, run as extra
+    # batch entries that share the image's features, and merged with NMS.
+    cfg.MODEL.DiffusionDet.NUM_CHAINS = 1
+    # With NOISE_SEED >= 0, inference noise comes from a bank drawn once with this seed, and
+    # every image gets the same noise. With NOISE_PER_IMAGE_SEED, images that have an
+    # "image_id" get noise drawn with a seed derived from NOISE_SEED and their id instead.
+    cfg.MODEL.DiffusionDet.NOISE_SEED = -1
+    cfg.MODEL.DiffusionDet.NOISE_PER_IMAGE_SEED = False
 
     # Inference
     cfg.MODEL.DiffusionDet.USE_NMS = True
+    # After each head stage listed in PRUNE_STAGES (0-based), only the corresponding number
+    # of highest-scoring proposals of each image in PRUNE_NUM_PROPOSALS go through later stages.
+    cfg.MODEL.DiffusionDet.PRUNE_STAGES = []
+    cfg.MODEL.DiffusionDet.PRUNE_NUM_PROPOSALS = []
+    # Adaptive sampling: an image stops after fewer than SAMPLE_STEP steps once its detections
+    # scoring above ADAPTIVE_SCORE_THRESH stop changing, i.e. each one matches a detection of
+    # the previous step with the same labels, IoU >= ADAPTIVE_IOU_THRESH and a score within
+    # ADAPTIVE_SCORE_DELTA. The number of steps run is returned as "sampling_steps".
+    cfg.MODEL.DiffusionDet.ADAPTIVE_SAMPLING = False
+    cfg.MODEL.DiffusionDet.ADAPTIVE_SCORE_THRESH = 0.5
+    cfg.MODEL.DiffusionDet.ADAPTIVE_IOU_THRESH = 0.9
+    cfg.MODEL.DiffusionDet.ADAPTIVE_SCORE_DELTA = 0.05
 
     # Swin Backbones
     cfg.MODEL.SWIN = CN()
     cfg.MODEL.SWIN.SIZE = 'B'  # 'T', 'S', 'B'
     cfg.MODEL.SWIN.USE_CHECKPOINT = False
+    # use F.scaled_dot_product_attention in the window attention (torch >= 2.0, else ignored)
+    cfg.MODEL.SWIN.FUSED_ATTENTION = False
     cfg.MODEL.SWIN.OUT_FEATURES = (0, 1, 2, 3)  # modify
 
     # Optimizer.
@@ -7,18 +7,21 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 import math
 import random
+import zlib
 from typing import List
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 import json
 
+import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.nn.utils.rnn import pad_sequence
 from detectron2.data import MetadataCatalog
 from detectron2.layers import batched_nms
 from detectron2.modeling import META_ARCH_REGISTRY, build_backbone, detector_postprocess
 
-from detectron2.structures import Boxes, ImageList, Instances
+from detectron2.structures import Boxes, ImageList, Instances, pairwise_iou
 
 from .loss import SetCriterionDynamicK, HungarianMatcherDynamicK
 from .head import DynamicHead
@@ -29,6 +32,9 @@ __all__ = ["DiffusionDet"]
 
 ModelPrediction = namedtuple('ModelPrediction', ['pred_noise', 'pred_x_start'])
 
+# per-image sampling noise kept on the device with NOISE_PER_IMAGE_SEED, in images
+_IMAGE_NOISE_CACHE_SIZE = 256
+
 
 def exists(x):
     return x is not None
@@ -101,6 +107,12 @@ class DiffusionDet(nn.Module):
         self.scale = cfg.MODEL.DiffusionDet.SNR_SCALE
         self.box_renewal = True
         self.use_ensemble = True
+        self.num_chains = cfg.MODEL.DiffusionDet.NUM_CHAINS
+        self.noise_seed = cfg.MODEL.DiffusionDet.NOISE_SEED
+        self.noise_per_image_seed = cfg.MODEL.DiffusionDet.NOISE_PER_IMAGE_SEED
+        self._noise_bank = None
+        self._noise_bank_key = None
+        self._image_noise = OrderedDict()  # image_id -> noise, most recently used last
 
         self.register_buffer('betas', betas)
         self.register_buffer('alphas_cumprod', alphas_cumprod)
@@ -140,6 +152,10 @@ class DiffusionDet(nn.Module):
         self.use_focal = cfg.MODEL.DiffusionDet.USE_FOCAL
         self.use_fed_loss = cfg.MODEL.DiffusionDet.USE_FED_LOSS
         self.use_nms = cfg.MODEL.DiffusionDet.USE_NMS
+        self.adaptive_sampling = cfg.MODEL.DiffusionDet.ADAPTIVE_SAMPLING
+        self.adaptive_score_thresh = cfg.MODEL.DiffusionDet.ADAPTIVE_SCORE_THRESH
+        self.adaptive_iou_thresh = cfg.MODEL.DiffusionDet.ADAPTIVE_IOU_THRESH
+        self.adaptive_score_delta = cfg.MODEL.DiffusionDet.ADAPTIVE_SCORE_DELTA
 
         # Build Criterion.
         matcher = HungarianMatcherDynamicK(
@@ -160,6 +176,9 @@ class DiffusionDet(nn.Module):
 
         pixel_mean = torch.Tensor(cfg.MODEL.PIXEL_MEAN).to(self.device).view(3, 1, 1)
         pixel_std = torch.Tensor(cfg.MODEL.PIXEL_STD).to(self.device).view(3, 1, 1)
+        if cfg.INPUT.FORMAT == "L":
+            # grayscale images keep a single channel; the patch embedding of the backbone is folded to match.
+            pixel_mean, pixel_std = pixel_mean.mean(0, keepdim=True), pixel_std.mean(0, keepdim=True)
         self.normalizer = lambda x: (x - pixel_mean) / pixel_std
         self.to(self.device)
         
@@ -267,7 +286,8 @@ class DiffusionDet(nn.Module):
                 extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
         )
 
-    def model_predictions(self, backbone_feats, images_whwh, x, t, x_self_cond=None, clip_x_start=False):
+    def model_predictions(self, backbone_feats, images_whwh, x, t, x_self_cond=None, clip_x_start=False,
+                          time_scale_shift=None, prune_level=None):
     
         
         x_boxes = torch.clamp(x, min=-1 * self.scale, max=self.scale)
@@ -275,7 +295,8 @@ class DiffusionDet(nn.Module):
         x_boxes = box_cxcywh_to_xyxy(x_boxes)
         
         x_boxes = x_boxes * images_whwh[:, None, :]
-        outputs_class, outputs_coord = self.head(backbone_feats, x_boxes, t, None)
+        outputs_class, outputs_coord = self.head(backbone_feats, x_boxes, t, None, time_scale_shift=time_scale_shift,
+                                                 prune_level=prune_level)
 
         x_start = outputs_coord[-1]  # (batch, num_proposals, 4) predict boxes: absolute coordinates (x1, y1, x2, y2)
         x_start = x_start / images_whwh[:, None, :]
@@ -323,8 +344,13 @@ class DiffusionDet(nn.Module):
        
         """
         
+        # the chains of an image are consecutive entries of the sampled batch
+        num_chains = self.num_chains
+        ensemble = self.use_ensemble and self.sampling_timesteps > 1
+        images_whwh = images_whwh.repeat_interleave(num_chains, dim=0)
+
         #shape = (batch, self.num_proposals-len(bbox_pretrain), 4)
-        shape = (batch, self.num_proposals, 4)
+        shape = (batch * num_chains, self.num_proposals, 4)
         #  print(batched_inputs)
         
         
@@ -335,44 +361,57 @@ class DiffusionDet(nn.Module):
         times = torch.linspace(-1, total_timesteps - 1, steps=sampling_timesteps + 1)
         times = list(reversed(times.int().tolist()))
         time_pairs = list(zip(times[:-1], times[1:]))  # [(T-1, T-2), (T-2, T-3), ..., (1, 0), (0, -1)]
-
-        img = torch.randn(shape, device=self.device)
+        # the schedule is fixed, so the time embeddings are computed once and reused across calls
+        time_scale_shifts = self.head.time_scale_shift_cache(times[:-1])
+
+        # initial boxes, then the DDIM and box renewal noise of each step but the last
+        sampling_noise = self.sampling_noise(batched_inputs, 1 + 2 * (len(time_pairs) - 1))
+        noise_rows = slice(None)  # the rows of sampling_noise of the entries still being sampled
+        if sampling_noise is None:
+            img = torch.randn(shape, device=self.device)
+        else:
+            img = sampling_noise[0]
         
         #img = torch.concat((img, torch.stack(bbox_pre)),1)
 
         
         
 
-        ensemble_score, ensemble_label, ensemble_coord = [], [], []
+        # Images still being sampled. With adaptive sampling, an image leaves the batch
+        # once its detections stop changing between steps.
+        active = list(range(batch))
+        num_steps = [0] * batch
+        last_outputs = [None] * batch  # per image: the class logits of each level and the boxes of its last step, per chain
+        previous_detections = [None] * batch
+        ensemble_outputs = [[] for _ in range(batch)]
         
         
         #boxes_pretrain=self.prepare_inferred_boxes(gt_instances)
         #print(boxes_pretrain.shape)
         
         x_start = None
-        for time, time_next in time_pairs:
-            time_cond = torch.full((batch,), time, device=self.device, dtype=torch.long)
+        for step, (time, time_next) in enumerate(time_pairs):
+            time_cond = torch.full((len(active) * num_chains,), time, device=self.device, dtype=torch.long)
             self_cond = x_start if self.self_condition else None
 
             preds, outputs_class, outputs_coord = self.model_predictions(backbone_feats, images_whwh, img, time_cond,
-                                                                         self_cond, clip_x_start=clip_denoised)
+                                                                         self_cond, clip_x_start=clip_denoised,
+                                                                         time_scale_shift=time_scale_shifts[time],
+                                                                         prune_level=k)
                                                                      
             pred_noise, x_start = preds.pred_noise, preds.pred_x_start
             
+            box_cls = [outputs_class[l][-1] for l in range(k + 1)]
+            for j, i in enumerate(active):
+                chains = slice(j * num_chains, (j + 1) * num_chains)
+                num_steps[i] += 1
+                last_outputs[i] = ([logits[chains] for logits in box_cls], outputs_coord[-1][chains])
 
             if self.box_renewal:  # filter
-                score_per_image, box_per_image = outputs_class[k][-1][0], outputs_coord[-1][0]
                 threshold = 0.5
-            
-                score_per_image = torch.sigmoid(score_per_image)
-                value, _ = torch.max(score_per_image, -1, keepdim=False)
-                keep_idx = value > threshold
-                #print(value)
-                num_remain = torch.sum(keep_idx)
-
-                pred_noise = pred_noise[:, keep_idx, :]
-                x_start = x_start[:, keep_idx, :]
-                img = img[:, keep_idx, :]
+                # (batch, num_proposals) mask of the boxes each image keeps; the others are
+                # replaced with fresh noise after the update, so every image keeps NUM_PROPOSALS boxes.
+                keep = torch.sigmoid(box_cls[k]).max(-1)[0] > threshold
             
             if time_next < 0:
                 
@@ -386,7 +425,10 @@ class DiffusionDet(nn.Module):
             sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
             c = (1 - alpha_next - sigma ** 2).sqrt()
 
-            noise = torch.randn_like(img)
+            if sampling_noise is None:
+                noise = torch.randn_like(img)
+            else:
+                noise = sampling_noise[2 * step + 1][noise_rows]
 
             img = x_start * alpha_next.sqrt() + \
                   c * pred_noise + \
@@ -395,75 +437,55 @@ class DiffusionDet(nn.Module):
             
             if self.box_renewal:  # filter
                 # replenish with randn boxes
-                #img = torch.cat((img, torch.randn(1, self.num_proposal-len(bbox_pretrain), 4, device=img.device)), dim=1)
-                img = torch.cat((img, torch.randn(1, self.num_proposal, 4, device=img.device)), dim=1)
-                img = torch.concat((img, torch.stack(bbox_pre)),1)
-
-            if self.use_ensemble and self.sampling_timesteps > 1:
-                
-                
-                box_pred_per_image, scores_per_image, labels_per_image = self.inference(outputs_class[0:k+1][-1],
-                                                                                        outputs_coord[-1],
-                                                                                        images.image_sizes, k)
-            
-                ensemble_score.append(scores_per_image)
-                ensemble_label.append(labels_per_image)
-                ensemble_coord.append(box_pred_per_image)
-            
-            
-            
-                
-            
+                if sampling_noise is None:
+                    renewal_noise = torch.randn_like(img)
+                else:
+                    renewal_noise = sampling_noise[2 * step + 2][noise_rows]
+                img = torch.where(keep[..., None], img, renewal_noise)
+
+            active_sizes = [images.image_sizes[i] for i in active]
+            if ensemble or (self.adaptive_sampling and num_chains > 1):
+                chain_sizes = [image_size for image_size in active_sizes for _ in range(num_chains)]
+                step_outputs = self.inference(box_cls, outputs_coord[-1], chain_sizes, k, nms=False)
+                step_outputs = [step_outputs[j * num_chains:(j + 1) * num_chains] for j in range(len(active))]
+            if ensemble:
+                for i, outputs in zip(active, step_outputs):
+                    ensemble_outputs[i].extend(outputs)
+
+            if self.adaptive_sampling:
+                if ensemble or num_chains > 1:
+                    detections = self._merge_predictions(active_sizes, step_outputs, k)
+                else:
+                    detections = self.inference(box_cls, outputs_coord[-1], active_sizes, k)
+                running = []
+                for j, (i, current) in enumerate(zip(active, detections)):
+                    if not self._detections_converged(previous_detections[i], current, k):
+                        running.append(j)
+                    previous_detections[i] = current
+                if len(running) < len(active):
+                    active = [active[j] for j in running]
+                    if not active:
+                        break
+                    rows = torch.as_tensor(running, device=self.device)
+                    backbone_feats = [feature[rows] for feature in backbone_feats]
+                    rows = (rows[:, None] * num_chains + torch.arange(num_chains, device=self.device)).flatten()
+                    img, x_start = img[rows], x_start[rows]
+                    images_whwh = images_whwh[rows]
+                    noise_rows = rows if isinstance(noise_rows, slice) else noise_rows[rows]
+
+        if ensemble:
+            results = self._merge_predictions(images.image_sizes, ensemble_outputs, k)
 
-        if self.use_ensemble and self.sampling_timesteps > 1:
-            box_pred_per_image = torch.cat(ensemble_coord, dim=0)
-            scores_per_image = torch.cat(ensemble_score, dim=0)
-            labels_per_image = torch.cat(ensemble_label, dim=0)
-            if self.use_nms:
-                keep = batched_nms(box_pred_per_image, scores_per_image, labels_per_image[k], 0.5)
-                box_pred_per_image = box_pred_per_image[keep]
-                scores_per_image = scores_per_image[keep]
-                labels_per_image = labels_per_image[keep]
-
-            result = Instances(images.image_sizes[0])
-            result.pred_boxes = Boxes(box_pred_per_image)
-            result.scores = scores_per_image
-            result.pred_classes_1 = labels_per_image[0]
-            if k>0:
-              result.pred_classes_2 = labels_per_image[1]  
-            if k>1:
-              result.pred_classes_3 = labels_per_image[2]
-            
-            results = [result]
-            
-           
-        
         else:
-            if k==0:
-              output = {'pred_logits_1': outputs_class[0][-1], 'pred_boxes': outputs_coord[-1]}
-            if k==1:
-               output = {'pred_logits_1': outputs_class[0][-1], 'pred_logits_2': outputs_class[1][-1],'pred_boxes': outputs_coord[-1]}
-               
-            if k==2:
-               output = {'pred_logits_1': outputs_class[0][-1], 'pred_logits_2': outputs_class[1][-1],'pred_logits_3': outputs_class[2][-1], 'pred_boxes': outputs_coord[-1]}
-            
-           
-            box_cls=[]
-            if k==0:
-              box_cls.append(output["pred_logits_1"])
-           
-            if k==1:
-              box_cls.append(output["pred_logits_1"])
-              box_cls.append(output["pred_logits_2"])
-            if k==2:
-              box_cls.append(output["pred_logits_1"])
-              box_cls.append(output["pred_logits_2"])
-              box_cls.append(output["pred_logits_3"])
-            
-            box_pred = output["pred_boxes"]
-            
-            
-            results = self.inference(box_cls, box_pred, images.image_sizes, k)
+            box_cls = [torch.cat([last_outputs[i][0][l] for i in range(batch)]) for l in range(k + 1)]
+            box_pred = torch.cat([last_outputs[i][1] for i in range(batch)])
+            if num_chains > 1:
+                chain_sizes = [image_size for image_size in images.image_sizes for _ in range(num_chains)]
+                outputs = self.inference(box_cls, box_pred, chain_sizes, k, nms=False)
+                outputs = [outputs[i * num_chains:(i + 1) * num_chains] for i in range(batch)]
+                results = self._merge_predictions(images.image_sizes, outputs, k)
+            else:
+                results = self.inference(box_cls, box_pred, images.image_sizes, k)
             #print(results)
         if do_postprocess:
             processed_results = []
@@ -473,10 +495,64 @@ class DiffusionDet(nn.Module):
                 width = input_per_image.get("width", image_size[1])
                 r = detector_postprocess(results_per_image, height, width)
                 processed_results.append({"instances": r})
+            if self.adaptive_sampling:
+                for processed, steps in zip(processed_results, num_steps):
+                    processed["sampling_steps"] = steps
              
            
             return processed_results
 
+    def sampling_noise(self, batched_inputs, num_draws):
+        """
+        The noise of one :meth:`ddim_sample` call, if `NOISE_SEED` is set.
+
+        The noise comes from a bank drawn once on the model device and reused by every
+        image, so the results of an image do not depend on the run or on the other
+        images of its batch. With `NOISE_PER_IMAGE_SEED`, the noise of an image with an
+        "image_id" is drawn with a seed derived from `NOISE_SEED` and its id instead, and
+        kept on the device for the next calls on the same image.
+
+        Returns:
+            Tensor or None: of shape (num_draws, batch_size * num_chains, num_proposals, 4),
+                or None if `NOISE_SEED` is negative.
+        """
+        if self.noise_seed < 0:
+            return None
+        num_rows = len(batched_inputs) * self.num_chains
+        shape = (num_draws, self.num_chains, self.num_proposals, 4)
+
+        key = (self.noise_seed, shape, str(self.device))
+        if key != self._noise_bank_key:
+            self._image_noise.clear()
+        if key != self._noise_bank_key or self._noise_bank.shape[1] < num_rows:
+            # drawn on the CPU, so that the noise is the same on every device
+            noise = torch.randn(shape, generator=torch.Generator().manual_seed(self.noise_seed))
+            self._noise_bank = noise.repeat(1, len(batched_inputs), 1, 1).to(self.device)
+            self._noise_bank_key = key
+        noise = self._noise_bank[:, :num_rows]
+
+        if self.noise_per_image_seed and any("image_id" in inputs for inputs in batched_inputs):
+            noise = torch.cat([
+                self._seeded_image_noise(inputs["image_id"], shape) if "image_id" in inputs
+                else noise[:, i * self.num_chains:(i + 1) * self.num_chains]
+                for i, inputs in enumerate(batched_inputs)
+            ], dim=1)
+        return noise
+
+    def _seeded_image_noise(self, image_id, shape):
+        """
+        The noise of one image with `NOISE_PER_IMAGE_SEED`, drawn on the CPU once per
+        image and then reused from the device.
+        """
+        noise = self._image_noise.pop(image_id, None)
+        if noise is None:
+            seed = zlib.crc32("{}:{}".format(self.noise_seed, image_id).encode())
+            noise = torch.randn(shape, generator=torch.Generator().manual_seed(seed)).to(self.device)
+        self._image_noise[image_id] = noise
+        if len(self._image_noise) > _IMAGE_NOISE_CACHE_SIZE:
+            self._image_noise.popitem(last=False)
+        return noise
+
     # forward diffusion
     def q_sample(self, x_start, t, noise=None):
         if noise is None:
@@ -535,40 +611,26 @@ class DiffusionDet(nn.Module):
             targets, x_boxes, noises, t = self.prepare_targets(gt_instances, boxes_pretrain)
            
             #print(noises)
-            t = t.squeeze(-1)
             x_boxes = x_boxes * images_whwh[:, None, :]
             
             
             
-            outputs_class, outputs_coord = self.head(features, x_boxes, t, None, freeze_class1=self.freeze_class1, freeze_class2=self.freeze_class2, freeze_class3=self.freeze_class3)
+            # only the levels the loss supervises are classified; with the quadrant level
+            # frozen, the loss is computed on the enumeration level alone.
+            freeze_class1 = self.freeze_class1
+            freeze_class2 = self.freeze_class2
+            freeze_class3 = self.freeze_class1 or self.freeze_class2 or self.freeze_class3
+            outputs_class, outputs_coord = self.head(features, x_boxes, t, None, freeze_class1=freeze_class1, freeze_class2=freeze_class2, freeze_class3=freeze_class3)
+            levels = [level for level, logits in enumerate(outputs_class, 1) if logits is not None]
             
-            if not self.freeze_class2 and not self.freeze_class3:
-              output = {'pred_logits_1': outputs_class[0][-1],'pred_logits_2': outputs_class[1][-1], 'pred_logits_3': outputs_class[2][-1], 'pred_boxes': outputs_coord[-1]}
-              
-              if self.deep_supervision:
-                output['aux_outputs'] = [{'pred_logits_1': a, 'pred_logits_2': b, 'pred_logits_3': c, 'pred_boxes': d}
-                                        for a, b, c, d in zip(outputs_class[0][:-1], outputs_class[1][:-1], outputs_class[2][:-1], outputs_coord[:-1])]
-          
-            if not self.freeze_class2 and self.freeze_class3:
-              output = {'pred_logits_1': outputs_class[0][-1], 'pred_logits_2': outputs_class[1][-1], 'pred_boxes': outputs_coord[-1]}
-              
-              if self.deep_supervision:
-                output['aux_outputs'] = [{'pred_logits_1': a, 'pred_logits_2': b, 'pred_boxes': c}
-                                        for a, b, c in zip(outputs_class[0][:-1], outputs_class[1][:-1], outputs_coord[:-1])]
-              
-            if self.freeze_class2 and self.freeze_class3:
-              output = {'pred_logits_1': outputs_class[0][-1], 'pred_boxes': outputs_coord[-1]}
-               
-              if self.deep_supervision:
-                output['aux_outputs'] = [{'pred_logits_1': a, 'pred_boxes': b}
-                                        for a, b in zip(outputs_class[0][:-1], outputs_coord[:-1])]
-            
-            if self.freeze_class1:
-                  output = {'pred_logits_2': outputs_class[0][-1], 'pred_boxes': outputs_coord[-1]}
-                   
-                  if self.deep_supervision:
-                    output['aux_outputs'] = [{'pred_logits_2': a, 'pred_boxes': b}
-                                            for a, b in zip(outputs_class[0][:-1], outputs_coord[:-1])]
+            output = {'pred_logits_{}'.format(level): outputs_class[level - 1][-1] for level in levels}
+            output['pred_boxes'] = outputs_coord[-1]
+            if self.deep_supervision:
+              output['aux_outputs'] = []
+              for head_idx in range(len(outputs_coord) - 1):
+                aux_output = {'pred_logits_{}'.format(level): outputs_class[level - 1][head_idx] for level in levels}
+                aux_output['pred_boxes'] = outputs_coord[head_idx]
+                output['aux_outputs'].append(aux_output)
           
             #print(outputs_coord)    
 
@@ -613,35 +675,49 @@ class DiffusionDet(nn.Module):
 
         return diff_boxes, noise, t
 
-    def prepare_diffusion_concat(self, gt_boxes, boxes_pretrain_new=None):
+    def prepare_diffusion_concat(self, gt_boxes, boxes_pretrain=None):
         """
-        :param gt_boxes: (cx, cy, w, h), normalized
-        :param num_proposals:
-        """
-        t = torch.randint(0, self.num_timesteps, (1,), device=self.device).long()
-        if boxes_pretrain_new != None:
-         
-          noise = torch.randn(self.num_proposals-len(boxes_pretrain_new), 4, device=self.device)
-          noise = torch.cat((boxes_pretrain_new, noise),0)
-        else:
-          noise = torch.randn(self.num_proposals, 4, device=self.device)
-        num_gt = gt_boxes.shape[0]
-        if not num_gt:  # generate fake gt boxes if empty gt boxes
-            gt_boxes = torch.as_tensor([[0.5, 0.5, 1., 1.]], dtype=torch.float, device=self.device)
-            num_gt = 1
+        Diffuse the boxes of all images at once.
 
-        if num_gt < self.num_proposals:
-            box_placeholder = torch.randn(self.num_proposals - num_gt, 4,
-                                          device=self.device) / 6. + 0.5  # 3sigma = 1/2 --> sigma: 1/6
-            box_placeholder[:, 2:] = torch.clip(box_placeholder[:, 2:], min=1e-4)
-            
-            x_start = torch.cat((gt_boxes, box_placeholder), dim=0)
-        elif num_gt > self.num_proposals:
-            select_mask = [True] * self.num_proposals + [False] * (num_gt - self.num_proposals)
-            random.shuffle(select_mask)
-            x_start = gt_boxes[select_mask]
-        else:
-            x_start = gt_boxes
+        :param gt_boxes: list of (num_gt, 4) tensors, the (cx, cy, w, h) normalized boxes of each image
+        :param boxes_pretrain: None, or list of (num_pretrain, 4) tensors, the (cx, cy, w, h) normalized
+            pretrained boxes of each image. They are diffused with the gt boxes, and replace the first
+            noise samples.
+        :return: the (batch_size, num_proposals, 4) diffused boxes and noise, and the (batch_size,) timesteps.
+        """
+        batch_size = len(gt_boxes)
+        t = torch.randint(0, self.num_timesteps, (batch_size,), device=self.device).long()
+        noise = torch.randn(batch_size, self.num_proposals, 4, device=self.device)
+        if boxes_pretrain is not None:
+            gt_boxes = [torch.cat((g, b), 0) for g, b in zip(gt_boxes, boxes_pretrain)]
+            num_pretrain = torch.as_tensor([len(b) for b in boxes_pretrain], device=self.device)
+            pretrain = pad_sequence(boxes_pretrain, batch_first=True)
+            is_pretrain = torch.arange(pretrain.shape[1], device=self.device) < num_pretrain[:, None]
+            noise[:, :pretrain.shape[1]] = torch.where(is_pretrain[..., None], pretrain, noise[:, :pretrain.shape[1]])
+
+        num_gt = [len(g) for g in gt_boxes]
+        # the gt boxes of all images, padded with the placeholder boxes to (at least) num_proposals
+        num_slots = max(max(num_gt), self.num_proposals)
+        box_placeholder = torch.randn(batch_size, num_slots, 4,
+                                      device=self.device) / 6. + 0.5  # 3sigma = 1/2 --> sigma: 1/6
+        box_placeholder[..., 2:] = torch.clip(box_placeholder[..., 2:], min=1e-4)
+        if min(num_gt) == 0:  # generate fake gt boxes if empty gt boxes
+            fake_box = box_placeholder.new_tensor([[0.5, 0.5, 1., 1.]])
+            gt_boxes = [g if len(g) else fake_box for g in gt_boxes]
+            num_gt = [max(n, 1) for n in num_gt]
+        num_gt_t = torch.as_tensor(num_gt, device=self.device)
+        slots = torch.arange(num_slots, device=self.device)
+        is_gt = slots < num_gt_t[:, None]
+        gt_padded = box_placeholder.new_zeros(batch_size, num_slots, 4)
+        gt_padded[:, :max(num_gt)] = pad_sequence(gt_boxes, batch_first=True)
+        x_start = torch.where(is_gt[..., None], gt_padded, box_placeholder)
+
+        if num_slots > self.num_proposals:
+            # an image with more gt boxes than proposals keeps a random subset of them, in order
+            select_key = torch.rand(batch_size, num_slots, device=self.device).masked_fill(~is_gt, 2.)
+            select_key = torch.where((num_gt_t > self.num_proposals)[:, None], select_key, slots.float())
+            select = select_key.topk(self.num_proposals, dim=1, largest=False)[1].sort(dim=1)[0]
+            x_start = x_start.gather(1, select[..., None].expand(-1, -1, 4))
 
         x_start = (x_start * 2. - 1.) * self.scale
 
@@ -656,327 +732,111 @@ class DiffusionDet(nn.Module):
         return diff_boxes, noise, t
 
     def prepare_targets(self, targets, boxes_pretrain=None):
+        """
+        :param targets: list of the gt Instances of each image
+        :param boxes_pretrain: None, or the output of :meth:`prepare_inferred_boxes`
+        """
+        # the levels labeled in this batch. A level is frozen if an image lacks it, so
+        # batches should come from a single label-completeness group, as produced by
+        # HierarchyGroupedTrainingSampler.
+        self.freeze_class1, self.freeze_class2, self.freeze_class3 = [
+            not all(t.has("gt_classes_{}".format(level)) for t in targets) for level in (1, 2, 3)]
+
+        # normalize the gt boxes of all images at once
+        image_sizes_xyxy = torch.as_tensor([[w, h, w, h] for h, w in (t.image_size for t in targets)],
+                                           dtype=torch.float, device=self.device)
+        num_gt = [len(t.gt_boxes) for t in targets]
+        gt_boxes_xyxy = torch.cat([t.gt_boxes.tensor for t in targets], 0).to(self.device)
+        image_size_xyxy_tgt = image_sizes_xyxy.repeat_interleave(
+            torch.as_tensor(num_gt, device=self.device), dim=0, output_size=sum(num_gt))
+        gt_boxes = box_xyxy_to_cxcywh(gt_boxes_xyxy / image_size_xyxy_tgt)
+
+        if boxes_pretrain is not None:
+            boxes_pretrain = box_xyxy_to_cxcywh(torch.cat(boxes_pretrain, 0)).split(
+                [len(b) for b in boxes_pretrain])
+        diffused_boxes, noises, ts = self.prepare_diffusion_concat(gt_boxes.split(num_gt), boxes_pretrain)
+
         new_targets = []
-        diffused_boxes = []
-        noises = []
-        ts = []
-        i=0
-        for targets_per_image in targets:
+        for i, (targets_per_image, gt_boxes_per_image, boxes_xyxy, image_size_xyxy_tgt_per_image) in enumerate(zip(
+                targets, gt_boxes.split(num_gt), gt_boxes_xyxy.split(num_gt), image_size_xyxy_tgt.split(num_gt))):
             target = {}
-            h, w = targets_per_image.image_size
-            image_size_xyxy = torch.as_tensor([w, h, w, h], dtype=torch.float, device=self.device)
-            #print(h,w)
-            #print(targets_per_image.gt_boxes.tensor)
-            try:
-              gt_classes_1 = targets_per_image.gt_classes_1
-            except:
-              self.freeze_class1=True
-            try:
-              gt_classes_2 = targets_per_image.gt_classes_2
-            except AttributeError:
-              self.freeze_class2=True
-            try:
-              gt_classes_3 = targets_per_image.gt_classes_3
-            except AttributeError:
-              self.freeze_class3=True
-            gt_boxes = targets_per_image.gt_boxes.tensor / image_size_xyxy
-            gt_boxes = box_xyxy_to_cxcywh(gt_boxes)
-            
-            try:
-                boxes_pretrain_new = box_xyxy_to_cxcywh(torch.stack(boxes_pretrain[i]))
-            except:
-              boxes_pretrain_new=None
-                
-            if boxes_pretrain_new != None:
-              
-              augmented_gt = torch.cat((gt_boxes, boxes_pretrain_new), 0)
-                          
-              d_boxes, d_noise, d_t = self.prepare_diffusion_concat(augmented_gt, boxes_pretrain_new)
-            else:
-              d_boxes, d_noise, d_t = self.prepare_diffusion_concat(gt_boxes)
-          
-           # d_boxes=d_boxes[return_arr]
-           
-            
-           
-              
-            i=i+1
-            
-            
-            diffused_boxes.append(d_boxes)
-            noises.append(d_noise)
-            ts.append(d_t)
             if not self.freeze_class1:
-              target["labels_1"] = gt_classes_1.to(self.device)
+              target["labels_1"] = targets_per_image.gt_classes_1.to(self.device)
             if not self.freeze_class2:
-              target["labels_2"] = gt_classes_2.to(self.device)
+              target["labels_2"] = targets_per_image.gt_classes_2.to(self.device)
             if not self.freeze_class3:
-              target["labels_3"] = gt_classes_3.to(self.device)
-            target["boxes"] = gt_boxes.to(self.device)
-            target["boxes_xyxy"] = targets_per_image.gt_boxes.tensor.to(self.device)
-            target["image_size_xyxy"] = image_size_xyxy.to(self.device)
-            image_size_xyxy_tgt = image_size_xyxy.unsqueeze(0).repeat(len(gt_boxes), 1)
-            target["image_size_xyxy_tgt"] = image_size_xyxy_tgt.to(self.device)
+              target["labels_3"] = targets_per_image.gt_classes_3.to(self.device)
+            target["boxes"] = gt_boxes_per_image
+            target["boxes_xyxy"] = boxes_xyxy
+            target["image_size_xyxy"] = image_sizes_xyxy[i]
+            target["image_size_xyxy_tgt"] = image_size_xyxy_tgt_per_image
             target["area"] = targets_per_image.gt_boxes.area().to(self.device)
             new_targets.append(target)
 
-        return new_targets, torch.stack(diffused_boxes), torch.stack(noises), torch.stack(ts)
-    def prepare_inferred_boxes(self,gt_instances):
-      return_boxes_total=[]
-      
-      for target in gt_instances:
-        return_boxes=[]
-        image_size = target.image_size
-        
-        try:
-          for bbox in target.boxes_pre[0]:
-            h, w = image_size
-            #print(h, w)
-            bbox = torch.as_tensor(bbox, dtype=torch.float, device=self.device)
-            #print(bbox)
-            image_size_xyxy = torch.as_tensor([w, h, w, h], dtype=torch.float, device=self.device)
-            bbox_normalized = bbox / image_size_xyxy
-            #print(bbox_normalized)
-            #bbox_normalized = box_xyxy_to_cxcywh(bbox_normalized)     
-            return_boxes.append(bbox_normalized)
-        except:
-          pass
-        return_boxes_total.append(return_boxes)
-      return return_boxes_total
-
-    def inference(self, box_cls, box_pred, image_sizes, k):
+        return new_targets, diffused_boxes, noises, ts
+
+    def prepare_inferred_boxes(self, gt_instances):
+        """
+        :param gt_instances: list of the gt Instances of each image
+        :return: list of (num_pretrain, 4) tensors, the normalized (x1, y1, x2, y2) pretrained
+            quadrant boxes of each image. Images without them get an empty tensor.
+        """
+        boxes_pre = []
+        image_sizes_xyxy = []
+        for target in gt_instances:
+            h, w = target.image_size
+            if target.has("boxes_pre") and len(target.boxes_pre) > 0:
+                boxes = np.asarray(target.boxes_pre[0], dtype=np.float32).reshape(-1, 4)
+            else:
+                boxes = np.zeros((0, 4), dtype=np.float32)
+            boxes_pre.append(boxes)
+            image_sizes_xyxy.append(np.tile(np.array([w, h, w, h], dtype=np.float32), (len(boxes), 1)))
+        boxes_pre_normalized = torch.as_tensor(
+            np.concatenate(boxes_pre) / np.concatenate(image_sizes_xyxy), device=self.device)
+        return list(boxes_pre_normalized.split([len(boxes) for boxes in boxes_pre]))
+
+    def inference(self, box_cls, box_pred, image_sizes, k, nms=True):
         """
         Arguments:
-            box_cls (Tensor): tensor of shape (batch_size, num_proposals, K).
+            box_cls (list[Tensor]): for each level up to `k`, a tensor of shape
+                (batch_size, num_proposals, K_level).
                 The tensor predicts the classification probability for each proposal.
             box_pred (Tensor): tensors of shape (batch_size, num_proposals, 4).
                 The tensor predicts 4-vector (x,y,w,h) box
                 regression values for every proposal
             image_sizes (List[torch.Size]): the input image sizes
+            k (int): index of the finest level to predict.
+            nms (bool): if False, return the predictions before NMS, to be merged with
+                other predictions of the same image by :meth:`_merge_predictions`.
         Returns:
             results (List[Instances]): a list of #images elements.
+                If `nms` is False, a (boxes, scores, labels) tuple per image instead.
         """
         assert len(box_cls[0]) == len(image_sizes)
         results = []
         
-        if self.use_focal or self.use__loss:
-            
-            if k==0:
-              scores_1 = torch.sigmoid(box_cls[0])
-            if k==1:
-              scores_1 = torch.sigmoid(box_cls[0])
-              scores_2 = torch.sigmoid(box_cls[1])
-            if k==2:
-              scores_1 = torch.sigmoid(box_cls[0])
-              scores_2 = torch.sigmoid(box_cls[1])
-              scores_3 = torch.sigmoid(box_cls[2])  
-              
-            
-            """
-            for l in range(k+1):
-              labels.append(torch.arange(self.num_classes[l], device=self.device).unsqueeze(0).repeat(self.num_proposals, 1).flatten(0, 1))
-            """
-            
-            if k==0:
-              labels_1 = torch.arange(self.num_classes[0], device=self.device).unsqueeze(0).repeat(self.num_proposals, 1).flatten(0, 1)
-            if k==1:
-              labels_1 = torch.arange(self.num_classes[0], device=self.device).unsqueeze(0).repeat(self.num_proposals, 1).flatten(0, 1)
-              labels_2 = torch.arange(self.num_classes[1], device=self.device).unsqueeze(0).repeat(self.num_proposals, 1).flatten(0, 1)
-            if k==2:
-              labels_1 = torch.arange(self.num_classes[0], device=self.device).unsqueeze(0).repeat(self.num_proposals, 1).flatten(0, 1)
-              labels_2 = torch.arange(self.num_classes[1], device=self.device).unsqueeze(0).repeat(self.num_proposals, 1).flatten(0, 1)
-              labels_3 = torch.arange(self.num_classes[2], device=self.device).unsqueeze(0).repeat(self.num_proposals, 1).flatten(0, 1)
-              
-            for i, (scores_per_image, box_pred_per_image, image_size) in enumerate(zip(
-                    scores_1, box_pred, image_sizes
-            )):
-                
-                result = Instances(image_size)
-                list_index=[]
-               
-                
-                #scores_1_flatten = scores_1[i].flatten(0, 1)
-                #scores_2_flatten = scores_2[i].flatten(0, 1)
-                
-                
-                """
-                for a in range(self.num_proposals):
-                  m = 0
-                  for k in range(self.num_classes[0]):
-                    z = 0
-                    for l in range(self.num_classes[1]):
-                      append_number= (scores_1_flatten[m]+scores_2_flatten[z])/2.0
-                      
-                      list_index.append(append_number)
-                      z=z+1
-                    m=m+1
-                print(list_index)
-                
-                """
-                
-                
-                #tensor_index = torch.stack(list_index)
-                
-              
-            
-                #print(tensor_index.max())
-                if k==0:
-                  scores_per_image_1, topk_indices1 = scores_1[i].flatten(0, 1).topk(self.num_proposals, sorted=False)
-                  scores_per_image=scores_per_image_1
-                  topk_indices=topk_indices1
-                  
-                  
-                
-                  
-               
-                if k==1:
-                  scores_per_image_2, topk_indices2 = scores_2[i].flatten(0, 1).topk(self.num_proposals, sorted=False)
-                  scores_per_image=scores_per_image_2
-                  topk_indices = topk_indices2
-                 
-                 
-                 
-                if k==2:
-                  scores_per_image_2, topk_indices2 = scores_2[i].flatten(0, 1).topk(self.num_proposals, sorted=False)
-                  scores_per_image_3, topk_indices3 = scores_3[i].flatten(0, 1).topk(self.num_proposals, sorted=False)
-                  scores_per_image =   scores_per_image_3
-                  topk_indices=topk_indices3
-                  
-                  
-                  topk_start = []
-                
-                
-                topk_indices_list = topk_indices.cpu().detach().numpy()
-               
-                topk_start = topk_indices_list//self.num_classes[k]
-                
-                #print(topk_start)
-                #print(topk_indices)
-                
-                
-                
-               
-                
-                
-                if k>=1:
-                  topk_indices1 = []
-                  for l in range(len(topk_start)):
-                    
-                    element = scores_1[i][topk_start[l]]
-                    arg=torch.argmax(element)
-                   
-                    new_element = (topk_start[l]*self.num_classes[0])+arg
-                    
-                    topk_indices1.append(new_element)
-                    
-                  
-                  topk_indices1=torch.stack(topk_indices1)
-                
-                if k>=2:
-                  topk_indices2 = []
-                  for l in range(len(topk_start)):
-                    
-                    element = scores_2[i][topk_start[l]]
-                    arg=torch.argmax(element)
-                   
-                    new_element = (topk_start[l]*self.num_classes[1])+arg
-                    
-                    topk_indices2.append(new_element)
-                    
-                  
-                  topk_indices2=torch.stack(topk_indices2)
-               
-                
-               
-               
-                
-                if k==0:
-                  labels_per_image_1=labels_1[topk_indices1]
-                  box_pred_per_image_1 = box_pred_per_image.view(-1, 1, 4).repeat(1, self.num_classes[0], 1).view(-1, 4)
-                  box_pred_per_image_1 = box_pred_per_image_1[topk_indices1]
-                
-                if k==1:  
-                  
-                  labels_per_image_1=labels_1[topk_indices1]
-                  labels_per_image_2=labels_2[topk_indices2]
-                  
-                  box_pred_per_image_1 = box_pred_per_image.view(-1, 1, 4).repeat(1, self.num_classes[0], 1).view(-1, 4)
-                  
-                  
-                  box_pred_per_image_1 = box_pred_per_image_1[topk_indices1]
-                  
-                  
-                  
-                  
-                  box_pred_per_image_2 = box_pred_per_image.view(-1, 1, 4).repeat(1, self.num_classes[1], 1).view(-1, 4)
-                  
-                 
-
-                  
-                  box_pred_per_image_2 = box_pred_per_image_2[topk_indices2]
-                  
-                  
-                  
-
-                if k==2:
-                  labels_per_image_1=labels_1[topk_indices1]
-                  labels_per_image_2=labels_2[topk_indices2]
-                  labels_per_image_3=labels_3[topk_indices3]
-                  
-                  box_pred_per_image_1 = box_pred_per_image.view(-1, 1, 4).repeat(1, self.num_classes[k], 1).view(-1, 4)
-                  box_pred_per_image_1 = box_pred_per_image_1[topk_indices]
-                  box_pred_per_image_2 = box_pred_per_image.view(-1, 1, 4).repeat(1, self.num_classes[k], 1).view(-1, 4)
-                  box_pred_per_image_2 = box_pred_per_image_2[topk_indices]
-                  box_pred_per_image_3 = box_pred_per_image.view(-1, 1, 4).repeat(1, self.num_classes[k], 1).view(-1, 4)
-                  box_pred_per_image_3 = box_pred_per_image_3[topk_indices]
-               
-                
-               
-                if self.use_ensemble and self.sampling_timesteps > 1:
-                    return box_pred_per_image, scores_per_image, labels_per_image
+        if self.use_focal or self.use_fed_loss:
+            scores = [torch.sigmoid(box_cls[l]) for l in range(k + 1)]
 
-                if self.use_nms:
-                    if k==0:
-                      keep = batched_nms(box_pred_per_image_1, scores_per_image, labels_per_image_1, 0.5)
-                    if k==1:
-                      keep = batched_nms(box_pred_per_image_2, scores_per_image, labels_per_image_2, 0.5) 
-                    if k==2:
-                      keep = batched_nms(box_pred_per_image_3, scores_per_image, labels_per_image_3, 0.5)
-                   
-                       
-                 
-                    box_pred_per_image_1 = box_pred_per_image_1[keep]
-                    labels_per_image_1=labels_per_image_1[keep]
-                    box_pred_per_image = box_pred_per_image_1
-                    if k==1:
-                      box_pred_per_image_2 = box_pred_per_image_2[keep]
-                      labels_per_image_2=labels_per_image_2[keep]
-                      box_pred_per_image = box_pred_per_image_2
-                    if k==2:
-                      box_pred_per_image_2 = box_pred_per_image_2[keep]
-                      box_pred_per_image_3 = box_pred_per_image_3[keep]
-                      labels_per_image_2=labels_per_image_2[keep]
-                      labels_per_image_3=labels_per_image_3[keep]
-                      box_pred_per_image = box_pred_per_image_3
-                    scores_per_image = scores_per_image[keep]
-                    
-                   
-                
-                result.pred_boxes = Boxes(box_pred_per_image)
-                result.scores = scores_per_image
-                
-                
-                if k==0:
-                  result.pred_classes_1 = labels_per_image_1
-                if k==1:
-                  result.pred_classes_1 = labels_per_image_1
-                  result.pred_classes_2 = labels_per_image_2
-                  
-                if k==2:
-                  result.pred_classes_1 = labels_per_image_1
-                  result.pred_classes_2 = labels_per_image_2
-                  result.pred_classes_3 = labels_per_image_3
-                results.append(result)
+            # Rank the (proposal, class) pairs of the finest predicted level, then read the
+            # coarser levels' labels off the same proposals, for all images at once.
+            num_proposals = scores[k].shape[1]
+            scores_topk, topk_indices = scores[k].flatten(1).topk(num_proposals, dim=1, sorted=False)
+            topk_proposals = topk_indices // self.num_classes[k]
+            labels_topk = [scores[l].argmax(-1).gather(1, topk_proposals) for l in range(k)]
+            labels_topk.append(topk_indices % self.num_classes[k])
+
+            for i, (box_pred_per_image, image_size) in enumerate(zip(box_pred, image_sizes)):
+                scores_per_image = scores_topk[i]
+                labels_per_image = [labels[i] for labels in labels_topk]
+                box_pred_per_image = box_pred_per_image[topk_proposals[i]]
+
+                if not nms:
+                    results.append((box_pred_per_image, scores_per_image, labels_per_image))
+                    continue
+
+                results.append(self._instances_after_nms(image_size, box_pred_per_image, scores_per_image,
+                                                         labels_per_image, k))
 
         else:
             # For each box we assign the best class or the second best if the best on is `no_object`.
@@ -1008,6 +868,93 @@ class DiffusionDet(nn.Module):
 
         return results
 
+    def _instances_after_nms(self, image_size, box_pred_per_image, scores_per_image, labels_per_image, k):
+        """
+        Build the Instances of one image from its ranked predictions.
+
+        Args:
+            labels_per_image (list[Tensor]): the labels of each predicted level, coarsest first.
+                Class-aware NMS uses the labels of level `k`.
+        """
+        if self.use_nms:
+            keep = batched_nms(box_pred_per_image, scores_per_image, labels_per_image[k], 0.5)
+            box_pred_per_image = box_pred_per_image[keep]
+            scores_per_image = scores_per_image[keep]
+            labels_per_image = [labels[keep] for labels in labels_per_image]
+
+        result = Instances(image_size)
+        result.pred_boxes = Boxes(box_pred_per_image)
+        result.scores = scores_per_image
+        result.pred_classes_1 = labels_per_image[0]
+        if k > 0:
+            result.pred_classes_2 = labels_per_image[1]
+        if k > 1:
+            result.pred_classes_3 = labels_per_image[2]
+        return result
+
+    def _merge_predictions(self, image_sizes, predictions, k):
+        """
+        Merge several predictions of each image, e.g. from several sampling steps or chains,
+        with one class-aware NMS over the whole batch.
+
+        Args:
+            predictions (list[list[tuple]]): for each image, the (boxes, scores, labels) tuples
+                returned by :meth:`inference` with `nms=False`.
+
+        Returns:
+            list[Instances]: the merged predictions of each image.
+        """
+        boxes = torch.cat([p[0] for image_predictions in predictions for p in image_predictions])
+        scores = torch.cat([p[1] for image_predictions in predictions for p in image_predictions])
+        labels = [torch.cat([p[2][l] for image_predictions in predictions for p in image_predictions])
+                  for l in range(k + 1)]
+        image_idx = torch.cat([torch.full_like(p[1], i, dtype=torch.long)
+                               for i, image_predictions in enumerate(predictions) for p in image_predictions])
+        if self.use_nms:
+            # offset the labels per image so that boxes of different images never suppress each other
+            keep = batched_nms(boxes, scores, image_idx * self.num_classes[k] + labels[k], 0.5)
+            boxes, scores, image_idx = boxes[keep], scores[keep], image_idx[keep]
+            labels = [labels_per_level[keep] for labels_per_level in labels]
+
+        results = []
+        for i, image_size in enumerate(image_sizes):
+            mask = image_idx == i
+            result = Instances(image_size)
+            result.pred_boxes = Boxes(boxes[mask])
+            result.scores = scores[mask]
+            result.pred_classes_1 = labels[0][mask]
+            if k > 0:
+                result.pred_classes_2 = labels[1][mask]
+            if k > 1:
+                result.pred_classes_3 = labels[2][mask]
+            results.append(result)
+        return results
+
+    def _detections_converged(self, previous, current, k):
+        """
+        Whether the detections of one image scoring above `ADAPTIVE_SCORE_THRESH` did not change
+        between two sampling steps: there are as many at both steps, and each one matches a
+        detection of the previous step with the same labels at every level, an IoU of at least
+        `ADAPTIVE_IOU_THRESH` and a score within `ADAPTIVE_SCORE_DELTA`.
+        """
+        if previous is None:
+            return False
+        previous = previous[previous.scores > self.adaptive_score_thresh]
+        current = current[current.scores > self.adaptive_score_thresh]
+        if len(previous) != len(current):
+            return False
+        if len(current) == 0:
+            return True
+
+        iou = pairwise_iou(current.pred_boxes, previous.pred_boxes)
+        for l in range(1, k + 2):
+            field = "pred_classes_{}".format(l)
+            iou[current.get(field)[:, None] != previous.get(field)[None, :]] = 0
+        best_iou, match = iou.max(dim=1)
+        if (best_iou < self.adaptive_iou_thresh).any():
+            return False
+        return bool(((current.scores - previous.scores[match]).abs() <= self.adaptive_score_delta).all())
+
     def preprocess_image(self, batched_inputs):
         """
         Normalize, pad and batch the input images.
@@ -90,8 +90,15 @@ class DynamicHead(nn.Module):
         num_heads = cfg.MODEL.DiffusionDet.NUM_HEADS
         rcnn_head = RCNNHead(cfg, d_model, num_classes, dim_feedforward, nhead, dropout, activation)
         self.head_series = _get_clones(rcnn_head, num_heads)
+        # the stages run one after the other, so their chunked DynamicConvs can share one workspace.
+        workspace = {}
+        for rcnn_head in self.head_series:
+            rcnn_head.inst_interact.workspace = workspace
         self.num_heads = num_heads
         self.return_intermediate = cfg.MODEL.DiffusionDet.DEEP_SUPERVISION
+        self.prune_stages = list(cfg.MODEL.DiffusionDet.PRUNE_STAGES)
+        self.prune_num_proposals = list(cfg.MODEL.DiffusionDet.PRUNE_NUM_PROPOSALS)
+        assert len(self.prune_stages) == len(self.prune_num_proposals)
 
         # Gaussian random feature embedding layer for time
         self.d_model = d_model
@@ -112,6 +119,9 @@ class DynamicHead(nn.Module):
             self.bias_value = -math.log((1 - prior_prob) / prior_prob)
         self._reset_parameters()
 
+        self._time_cache = None
+        self._time_cache_key = None
+
     def _reset_parameters(self):
         # init all parameters.
         for p in self.parameters():
@@ -127,6 +137,12 @@ class DynamicHead(nn.Module):
                 if p.shape[-1] == self.num_classes[2] or p.shape[-1] == self.num_classes[2] + 1:
                     nn.init.constant_(p, self.bias_value)
 
+        # the fused classifier's bias does not have the size of a single level.
+        if self.use_focal or self.use_fed_loss:
+            for rcnn_head in self.head_series:
+                if rcnn_head.fuse_cls_logits:
+                    nn.init.constant_(rcnn_head.class_logits.bias, self.bias_value)
+
     @staticmethod
     def _init_box_pooler(cfg, input_shape):
 
@@ -151,17 +167,56 @@ class DynamicHead(nn.Module):
         )
         return box_pooler
 
-    def forward(self, features, init_bboxes, t, init_features, freeze_class1=False, freeze_class2=False, freeze_class3=False):
-        # assert t shape (batch_size)
-        
-        time = self.time_mlp(t)
+    def time_scale_shift_cache(self, timesteps):
+        """
+        Precompute the time embedding and every head's scale/shift for a fixed
+        sampling schedule. The cache is rebuilt when the timesteps differ from the
+        previous call or when the time MLP weights were modified or moved.
+
+        Args:
+            timesteps (list[int]): the timesteps of the schedule.
+
+        Returns:
+            dict[int, Tensor]: for each timestep, the scale/shift of every head, of shape
+                (num_heads, 1, d_model * 2). Pass it as `time_scale_shift` to :meth:`forward`.
+        """
+        params = list(self.time_mlp.parameters())
+        for rcnn_head in self.head_series:
+            params.extend(rcnn_head.block_time_mlp.parameters())
+        key = (tuple(timesteps), tuple((p.data_ptr(), p._version) for p in params))
+        if key != self._time_cache_key:
+            with torch.no_grad():
+                t = torch.as_tensor(timesteps, dtype=torch.long, device=params[0].device)
+                time = self.time_mlp(t)
+                scale_shift = torch.stack([rcnn_head.block_time_mlp(time) for rcnn_head in self.head_series], dim=1)
+            self._time_cache = {step: s[:, None] for step, s in zip(timesteps, scale_shift)}
+            self._time_cache_key = key
+        return self._time_cache
+
+    def forward(self, features, init_bboxes, t, init_features, freeze_class1=False, freeze_class2=False, freeze_class3=False,
+                time_scale_shift=None, prune_level=None):
+        """
+        Args:
+            t (Tensor): the timestep of each image, of shape (batch_size,).
+            time_scale_shift (Tensor or None): if given, an entry of :meth:`time_scale_shift_cache`
+                for `t`, which must then be the same for all images. The time MLPs are skipped.
+            prune_level (int or None): at inference, the hierarchy level whose scores rank the
+                proposals kept after the stages in `PRUNE_STAGES`. Dropped proposals keep the
+                predictions of the stage that dropped them, so the outputs have the same shape
+                as without pruning.
+            freeze_class1/2/3 (bool): the classification logits of a frozen level are not
+                computed, and are returned as None.
+        """
+        if time_scale_shift is None:
+            time = self.time_mlp(t)
+            time_scale_shift = [rcnn_head.block_time_mlp(time) for rcnn_head in self.head_series]
 
         inter_class_logits_1 = []
         inter_class_logits_2 = []
         inter_class_logits_3 = []
         inter_pred_bboxes = []
 
-        bs = len(features[0])
+        bs = len(init_bboxes)
         bboxes = init_bboxes
      
         num_boxes = bboxes.shape[1]
@@ -171,29 +226,69 @@ class DynamicHead(nn.Module):
             proposal_features = init_features.clone()
         else:
             proposal_features = None
-        
+
+        prune = not self.training and prune_level is not None and len(self.prune_stages) > 0
+        keep = None  # (bs, num_kept) indices of the proposals still being refined
         for head_idx, rcnn_head in enumerate(self.head_series):
             
-            class_logits_1, class_logits_2, class_logits_3, pred_bboxes, proposal_features = rcnn_head(features, bboxes, proposal_features, self.box_pooler, time, freeze_class1, freeze_class2, freeze_class3)
-            
-            
+            class_logits_1, class_logits_2, class_logits_3, pred_bboxes, proposal_features = rcnn_head(features, bboxes, proposal_features, self.box_pooler, time_scale_shift[head_idx], freeze_class1, freeze_class2, freeze_class3)
+            bboxes = pred_bboxes.detach()
+
+            if prune:
+                kept_outputs = [class_logits_1, class_logits_2, class_logits_3, pred_bboxes]
+                if keep is not None:
+                    outputs = [part if part is None else _scatter_proposals(full, keep, part)
+                               for full, part in zip(outputs, kept_outputs)]
+                else:
+                    outputs = kept_outputs
+                class_logits_1, class_logits_2, class_logits_3, pred_bboxes = outputs
+
+                if head_idx in self.prune_stages:
+                    num_keep = self.prune_num_proposals[self.prune_stages.index(head_idx)]
+                    kept = self._top_proposals(kept_outputs[prune_level], num_keep)
+                    keep = kept if keep is None else keep.gather(1, kept)
+                    bboxes = _gather_proposals(bboxes, kept)
+                    proposal_features = _gather_proposals(proposal_features.view(bs, -1, self.d_model), kept)
+                    proposal_features = proposal_features.view(1, -1, self.d_model)
+
             if self.return_intermediate:
                 inter_class_logits_1.append(class_logits_1)
                 inter_class_logits_2.append(class_logits_2)
                 inter_class_logits_3.append(class_logits_3)
                 inter_pred_bboxes.append(pred_bboxes)
-            bboxes = pred_bboxes.detach()
         
         if self.return_intermediate:
             #print(inter_class_logits[0])
-            return [torch.stack(inter_class_logits_1),torch.stack(inter_class_logits_2),torch.stack(inter_class_logits_3)] , torch.stack(inter_pred_bboxes)
+            inter_class_logits = [inter_class_logits_1, inter_class_logits_2, inter_class_logits_3]
+            return [None if logits[0] is None else torch.stack(logits) for logits in inter_class_logits], torch.stack(inter_pred_bboxes)
         
-        class_logits_return = [class_logits[0][None], class_logits[1][None], class_logits[2][None]]
+        class_logits_return = [None if logits is None else logits[None] for logits in (class_logits_1, class_logits_2, class_logits_3)]
 
         
         
         return class_logits_return, pred_bboxes[None]
 
+    def _top_proposals(self, class_logits, num_keep):
+        """
+        Returns the (bs, num_keep) indices of the proposals with the highest class score.
+        """
+        if self.use_focal or self.use_fed_loss:
+            scores = class_logits.sigmoid()
+        else:
+            scores = F.softmax(class_logits, dim=-1)[..., :-1]
+        scores = scores.max(-1)[0]
+        return scores.topk(min(num_keep, scores.shape[1]), dim=1)[1]
+
+
+def _gather_proposals(x, idx):
+    # x: (bs, num_proposals, C), idx: (bs, K)
+    return x.gather(1, idx[..., None].expand(-1, -1, x.shape[-1]))
+
+
+def _scatter_proposals(full, idx, part):
+    # writes part (bs, K, C) into a copy of full (bs, num_proposals, C) at the proposals idx (bs, K)
+    return full.scatter(1, idx[..., None].expand(-1, -1, full.shape[-1]), part)
+
 
 class RCNNHead(nn.Module):
 
@@ -244,31 +339,37 @@ class RCNNHead(nn.Module):
         # pred.
         self.use_focal = cfg.MODEL.DiffusionDet.USE_FOCAL
         self.use_fed_loss = cfg.MODEL.DiffusionDet.USE_FED_LOSS
+        self.fuse_cls_logits = cfg.MODEL.DiffusionDet.FUSE_CLS_LOGITS
         if self.use_focal or self.use_fed_loss:
-            
-            self.class_logits_quadrant = nn.Linear(d_model, num_classes[0])
-            self.class_logits_enumeration = nn.Linear(d_model, num_classes[1])
-            self.class_logits_disease = nn.Linear(d_model, num_classes[2])
+            self.num_logits = list(num_classes)
+        else:
+            self.num_logits = [c + 1 for c in num_classes]
+        if self.fuse_cls_logits:
+            # one projection for the quadrant, enumeration and disease logits, in that order.
+            self.class_logits = nn.Linear(d_model, sum(self.num_logits))
         else:
-            self.class_logits_quadrant = nn.Linear(d_model, num_classes[0] + 1)
-            self.class_logits_enumeration= nn.Linear(d_model, num_classes[1] + 1)
-            self.class_logits_disease = nn.Linear(d_model, num_classes[2] + 1)
+            self.class_logits_quadrant = nn.Linear(d_model, self.num_logits[0])
+            self.class_logits_enumeration = nn.Linear(d_model, self.num_logits[1])
+            self.class_logits_disease = nn.Linear(d_model, self.num_logits[2])
         self.bboxes_delta = nn.Linear(d_model, 4)
         self.scale_clamp = scale_clamp
         self.bbox_weights = bbox_weights
 
-    def forward(self, features, bboxes, pro_features, pooler, time_emb,  freeze_class1, freeze_class2, freeze_class3):
+    def forward(self, features, bboxes, pro_features, pooler, scale_shift,  freeze_class1, freeze_class2, freeze_class3):
         """
-        :param bboxes: (N, nr_boxes, 4)
+        :param bboxes: (N, nr_boxes, 4). N may be a multiple of the number of images in
+            `features`, with consecutive box sets belonging to the same image.
         :param pro_features: (N, nr_boxes, d_model)
+        :param scale_shift: (N, d_model * 2) or (1, d_model * 2), the output of block_time_mlp
         """
         
         N, nr_boxes = bboxes.shape[:2]
         
         # roi_feature.
+        # the box sets of an image are pooled as one list, so its features are not repeated.
         proposal_boxes = list()
-        for b in range(N):
-            proposal_boxes.append(Boxes(bboxes[b]))
+        for image_boxes in bboxes.view(len(features[0]), -1, 4):
+            proposal_boxes.append(Boxes(image_boxes))
         roi_features = pooler(features, proposal_boxes)
 
         if pro_features is None:
@@ -293,45 +394,52 @@ class RCNNHead(nn.Module):
         obj_features = obj_features + self.dropout3(obj_features2)
         obj_features = self.norm3(obj_features)
         
-        fc_feature = obj_features.transpose(0, 1).reshape(N * nr_boxes, -1)
-
-        scale_shift = self.block_time_mlp(time_emb)
-        scale_shift = torch.repeat_interleave(scale_shift, nr_boxes, dim=0)
-        scale, shift = scale_shift.chunk(2, dim=1)
-        fc_feature = fc_feature * (scale + 1) + shift
+        fc_feature = obj_features.transpose(0, 1).reshape(N, nr_boxes, -1)
 
-        cls_feature_1 = fc_feature.clone()
+        scale, shift = scale_shift[:, None].chunk(2, dim=-1)
+        fc_feature = (fc_feature * (scale + 1) + shift).view(N * nr_boxes, -1)
 
-        cls_feature_2 = fc_feature.clone()
-        
-        cls_feature_3 = fc_feature.clone()
-        reg_feature = fc_feature.clone()
+        # the three levels share the classification tower, so it is run once and
+        # its output feeds the three per-level classifiers.
+        cls_feature = fc_feature
+        reg_feature = fc_feature
         for cls_layer in self.cls_module:
-            cls_feature_1 = cls_layer(cls_feature_1)
-            cls_feature_2 = cls_layer(cls_feature_2)
-            cls_feature_3 = cls_layer(cls_feature_3)
+            cls_feature = cls_layer(cls_feature)
         for reg_layer in self.reg_module:
             reg_feature = reg_layer(reg_feature)
-            
-        
-       
-                  
-        class_logits_quadrant = self.class_logits_quadrant(cls_feature_1)
-        class_logits_enumeration = self.class_logits_enumeration(cls_feature_2)
-        class_logits_disease = self.class_logits_disease(cls_feature_3)
+
+        # the classifiers of the frozen levels are skipped, as those levels are not supervised.
+        compute = (not freeze_class1, not freeze_class2, not freeze_class3)
+        if self.fuse_cls_logits and all(compute):
+            class_logits = self.class_logits(cls_feature).split(self.num_logits, dim=-1)
+        elif self.fuse_cls_logits:
+            weights = self.class_logits.weight.split(self.num_logits, dim=0)
+            biases = self.class_logits.bias.split(self.num_logits, dim=0)
+            class_logits = [F.linear(cls_feature, weight, bias) if c else None
+                            for weight, bias, c in zip(weights, biases, compute)]
+        else:
+            classifiers = (self.class_logits_quadrant, self.class_logits_enumeration, self.class_logits_disease)
+            class_logits = [classifier(cls_feature) if c else None for classifier, c in zip(classifiers, compute)]
         bboxes_deltas = self.bboxes_delta(reg_feature)
         pred_bboxes = self.apply_deltas(bboxes_deltas, bboxes.view(-1, 4))
+        class_logits_quadrant, class_logits_enumeration, class_logits_disease = \
+            [None if logits is None else logits.view(N, nr_boxes, -1) for logits in class_logits]
         
-        if freeze_class1:
-          class_logits_quadrant.detach()
-      
-        if freeze_class2:
-          class_logits_enumeration.detach()
-          
-        if freeze_class3:
-          class_logits_disease.detach()
-        
-        return class_logits_quadrant.view(N, nr_boxes, -1), class_logits_enumeration.view(N, nr_boxes, -1), class_logits_disease.view(N, nr_boxes, -1), pred_bboxes.view(N, nr_boxes, -1), obj_features
+        return class_logits_quadrant, class_logits_enumeration, class_logits_disease, pred_bboxes.view(N, nr_boxes, -1), obj_features
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Convert between the per-level classifiers and the fused one, so that
+        # checkpoints of either layout load into both.
+        separate = ["class_logits_quadrant", "class_logits_enumeration", "class_logits_disease"]
+        for param in ("weight", "bias"):
+            separate_keys = [prefix + name + "." + param for name in separate]
+            fused_key = prefix + "class_logits." + param
+            if self.fuse_cls_logits and all(key in state_dict for key in separate_keys):
+                state_dict[fused_key] = torch.cat([state_dict.pop(key) for key in separate_keys], dim=0)
+            elif not self.fuse_cls_logits and fused_key in state_dict:
+                for key, value in zip(separate_keys, state_dict.pop(fused_key).split(self.num_logits, dim=0)):
+                    state_dict[key] = value
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def apply_deltas(self, deltas, boxes):
         """
@@ -395,11 +503,17 @@ class DynamicConv(nn.Module):
         self.out_layer = nn.Linear(num_output, self.hidden_dim)
         self.norm3 = nn.LayerNorm(self.hidden_dim)
 
+        self.chunk_size = cfg.MODEL.DiffusionDet.DYNAMIC_CONV_CHUNK_SIZE
+        self.workspace = {}
+
     def forward(self, pro_features, roi_features):
         '''
         pro_features: (1,  N * nr_boxes, self.d_model)
         roi_features: (49, N * nr_boxes, self.d_model)
         '''
+        if self.chunk_size > 0 and not torch.is_grad_enabled():
+            return self._chunked_forward(pro_features, roi_features)
+
         features = roi_features.permute(1, 0, 2)
         parameters = self.dynamic_layer(pro_features).permute(1, 0, 2)
 
@@ -421,6 +535,52 @@ class DynamicConv(nn.Module):
 
         return features
 
+    def _get_workspace(self, name, shape, like):
+        """
+        A view of shape `shape` into a buffer that is kept between calls and only
+        reallocated when it is too small or on another device or dtype.
+        """
+        numel = int(np.prod(shape))
+        buffer = self.workspace.get(name)
+        if buffer is None or buffer.numel() < numel or buffer.device != like.device or buffer.dtype != like.dtype:
+            buffer = like.new_empty(numel)
+            self.workspace[name] = buffer
+        return buffer[:numel].view(shape)
+
+    def _chunked_forward(self, pro_features, roi_features):
+        """
+        Same as :meth:`forward`, but the dynamic parameters are generated and applied for
+        at most `chunk_size` proposals at a time, in workspace buffers that are reused
+        across chunks and calls. Only used without autograd.
+        """
+        pro_features = pro_features[0]
+        num_boxes = pro_features.shape[0]
+        chunk_size = min(self.chunk_size, num_boxes)
+        resolution = roi_features.shape[0]
+        parameters = self._get_workspace("parameters", (chunk_size, self.num_dynamic * self.num_params), pro_features)
+        features1 = self._get_workspace("features1", (chunk_size, resolution, self.dim_dynamic), pro_features)
+        features2 = self._get_workspace("features2", (chunk_size, resolution, self.hidden_dim), pro_features)
+        output = pro_features.new_empty(num_boxes, self.hidden_dim)
+
+        for start in range(0, num_boxes, chunk_size):
+            end = min(start + chunk_size, num_boxes)
+            n = end - start
+            params = torch.addmm(self.dynamic_layer.bias, pro_features[start:end], self.dynamic_layer.weight.t(),
+                                 out=parameters[:n])
+            param1 = params[:, :self.num_params].view(n, self.hidden_dim, self.dim_dynamic)
+            param2 = params[:, self.num_params:].view(n, self.dim_dynamic, self.hidden_dim)
+
+            features = torch.bmm(roi_features[:, start:end].transpose(0, 1), param1, out=features1[:n])
+            features = self.activation(self.norm1(features))
+
+            features = torch.bmm(features, param2, out=features2[:n])
+            features = self.activation(self.norm2(features))
+
+            features = self.out_layer(features.flatten(1))
+            output[start:end] = self.activation(self.norm3(features))
+
+        return output
+
 
 def _get_clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for i in range(N)])
@@ -11,8 +11,8 @@ DiffusionDet model and criterion classes.
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.nn.utils.rnn import pad_sequence
 from fvcore.nn import sigmoid_focal_loss_jit
-import torchvision.ops as ops
 from .util import box_ops
 from .util.misc import get_world_size, is_dist_avail_and_initialized
 from .util.box_ops import box_cxcywh_to_xyxy, box_xyxy_to_cxcywh, generalized_box_iou
@@ -41,6 +41,16 @@ class SetCriterionDynamicK(nn.Module):
         self.eos_coef = eos_coef
         self.losses = losses
         self.use_focal = use_focal
+        self.shared_assignment = cfg.MODEL.DiffusionDet.SHARED_ASSIGNMENT
+        self.shared_assignment_head = cfg.MODEL.DiffusionDet.SHARED_ASSIGNMENT_HEAD
+        # without deep supervision only the final head has outputs
+        num_heads = cfg.MODEL.DiffusionDet.NUM_HEADS if cfg.MODEL.DiffusionDet.DEEP_SUPERVISION else 1
+        if self.shared_assignment and not -num_heads <= self.shared_assignment_head < num_heads:
+            raise ValueError(
+                "MODEL.DiffusionDet.SHARED_ASSIGNMENT_HEAD = {} does not index one of the {} supervised heads "
+                "(NUM_HEADS = {}, DEEP_SUPERVISION = {})".format(
+                    self.shared_assignment_head, num_heads,
+                    cfg.MODEL.DiffusionDet.NUM_HEADS, cfg.MODEL.DiffusionDet.DEEP_SUPERVISION))
         
         self.use_fed_loss = cfg.MODEL.DiffusionDet.USE_FED_LOSS
         if self.use_fed_loss:
@@ -206,26 +216,18 @@ class SetCriterionDynamicK(nn.Module):
         
         
         
-        try:
+        # a level is frozen for this batch when its logits are not in the outputs
+        self.freeze_class1, self.freeze_class2, self.freeze_class3 = [
+            "pred_logits_{}".format(level) not in outputs for level in (1, 2, 3)]
+        if not self.freeze_class1:
           target_classes_1 = torch.full(src_logits_1.shape[:2], self.num_classes[0],
                                       dtype=torch.int64, device=src_logits_1.device)
-          self.freeze_class1=False
-        except:
-          self.freeze_class1=True
-        try:                            
+        if not self.freeze_class2:
           target_classes_2 = torch.full(src_logits_2.shape[:2], self.num_classes[1],
                                       dtype=torch.int64, device=src_logits_2.device)
-          self.freeze_class2=False
-        except:
-          self.freeze_class2=True
-        
-        try:
+        if not self.freeze_class3:
           target_classes_3 = torch.full(src_logits_3.shape[:2], self.num_classes[2],
                                       dtype=torch.int64, device=src_logits_3.device)
-          self.freeze_class3=False
-        except:
-          self.freeze_class3=True
-                                    
         
         src_logits_list_1 = []
         src_logits_list_2 = []
@@ -365,19 +367,12 @@ class SetCriterionDynamicK(nn.Module):
               cls_loss=[cls_loss_2]  
             if self.use_fed_loss:
                 K = self.num_classes
-                try:
+                if not self.freeze_class1:
                   N1 = src_logits_1.shape[0]
-                except:
-                  pass
-                try:
+                if not self.freeze_class2:
                   N2 = src_logits_2.shape[0]
-                except:
-                  pass
-                
-                try:  
+                if not self.freeze_class3:
                   N3 = src_logits_3.shape[0]
-                except:
-                  pass
                   
                 if not self.freeze_class2 and not self.freeze_class3:       
                   N=[N1,N2,N3]
@@ -390,35 +385,27 @@ class SetCriterionDynamicK(nn.Module):
                 if self.freeze_class1:
                   N=[N2]
                   
-                try:
-                  
+                if not self.freeze_class1:
                   fed_loss_classes_1 = self.get_fed_loss_classes(
                       gt_classes_1,
                       num_fed_loss_classes=self.fed_loss_num_classes,
                       num_classes=K[0],
                       weight=self.fed_loss_cls_weights_1,
                   )
-                except:
-                  pass
-                try:
+                if not self.freeze_class2:
                   fed_loss_classes_2 = self.get_fed_loss_classes(
                       gt_classes_2,
                       num_fed_loss_classes=self.fed_loss_num_classes,
                       num_classes=K[1],
                       weight=self.fed_loss_cls_weights_2,
                   )
-                except:
-                  pass
-                  
-                try:    
+                if not self.freeze_class3:
                   fed_loss_classes_3 = self.get_fed_loss_classes(
                       gt_classes_3,
                       num_fed_loss_classes=self.fed_loss_num_classes,
                       num_classes=K[2],
                       weight=self.fed_loss_cls_weights_3,
                   )
-                except:
-                  pass
                   
                   
                 if not self.freeze_class2 and not self.freeze_class3:   
@@ -549,16 +536,20 @@ class SetCriterionDynamicK(nn.Module):
         outputs_without_aux={k: v for k, v in outputs.items() if k != 'aux_outputs'}
 
         # Retrieve the matching between the outputs of the last layer and the targets
-       
-        
-        indices, _ = self.matcher(outputs_without_aux, targets)
+        if self.shared_assignment:
+            # match once on the chosen head and reuse the assignment for all heads
+            head_outputs = outputs.get('aux_outputs', []) + [outputs_without_aux]
+            if not -len(head_outputs) <= self.shared_assignment_head < len(head_outputs):
+                raise ValueError("SHARED_ASSIGNMENT_HEAD = {} does not index one of the {} head outputs".format(
+                    self.shared_assignment_head, len(head_outputs)))
+            indices, _ = self.matcher(head_outputs[self.shared_assignment_head], targets)
+            shared_indices = indices
+        else:
+            indices, _ = self.matcher(outputs_without_aux, targets)
         
 
         # Compute the average number of target boxes accross all nodes, for normalization purposes
-        try:
-          num_boxes = sum(len(t["labels_1"]) for t in targets)
-        except:
-          num_boxes = sum(len(t["labels_2"]) for t in targets)
+        num_boxes = sum(len(t["boxes"]) for t in targets)
         num_boxes = torch.as_tensor([num_boxes], dtype=torch.float, device=next(iter(outputs.values())).device)
         if is_dist_avail_and_initialized():
             torch.distributed.all_reduce(num_boxes)
@@ -573,8 +564,10 @@ class SetCriterionDynamicK(nn.Module):
         if 'aux_outputs' in outputs:
             
             for i, aux_outputs in enumerate(outputs['aux_outputs']):
-                
-                indices, _ = self.matcher(aux_outputs, targets)
+                if self.shared_assignment:
+                    indices = shared_indices
+                else:
+                    indices, _ = self.matcher(aux_outputs, targets)
                 for loss in self.losses:
                     if loss == 'masks':
                         # Intermediate masks losses are too costly to compute, we ignore them.
@@ -620,281 +613,162 @@ class HungarianMatcherDynamicK(nn.Module):
         self.freeze_layer3=False
 
     def forward(self, outputs, targets):
-        """ simOTA for detr"""
-        
+        """ simOTA for detr
+
+        All images are matched at once: their targets are padded to the largest number of
+        boxes in the batch, and the padded columns of the cost are masked out.
+        """
         with torch.no_grad():
-            try:
-              bs, num_queries = outputs["pred_logits_1"].shape[:2]
-            except:
-              bs, num_queries = outputs["pred_logits_2"].shape[:2]
+            out_bbox = outputs["pred_boxes"]  # [batch_size, num_queries, 4]
+            bs, num_queries = out_bbox.shape[:2]
+            assert bs == len(targets)
+
+            # a level whose logits are missing is frozen for this batch, as in the criterion
+            for level in range(1, 4):
+                setattr(self, "freeze_layer{}".format(level), "pred_logits_{}".format(level) not in outputs)
+            if self.freeze_layer1:
+                levels = [2]
+            else:
+                levels = [l for l in range(1, 4) if not getattr(self, "freeze_layer{}".format(l))]
+
             # We flatten to compute the cost matrices in a batch
             if self.use_focal or self.use_fed_loss:
-                try:
-                  out_prob_1=outputs["pred_logits_1"].sigmoid()
-                except:
-                  self.freeze_layer1=True
-                try:
-                  out_prob_2=outputs["pred_logits_2"].sigmoid()
-                except:
-                  self.freeze_layer2=True  
-                  
-                  
-                try:  
-                  out_prob_3=outputs["pred_logits_3"].sigmoid()  # [batch_size, num_queries, num_classes
-                except:
-                  self.freeze_layer3=True
-                  
-                out_bbox = outputs["pred_boxes"]  # [batch_size,  num_queries, 4]
+                out_prob = [outputs["pred_logits_{}".format(l)].sigmoid() for l in levels]  # [batch_size, num_queries, num_classes]
             else:
-                out_prob_1=outputs["pred_logits_1"].softmax(-1)  # [batch_size, num_queries, num_classes]
-                try:
-                  out_prob_2=outputs["pred_logits_2"].softmax(-1)
-                except:
-                  pass
-                  
-                try:
-                  out_prob_3=outputs["pred_logits_3"].softmax(-1)
-                except:
-                  pass
-                out_bbox = outputs["pred_boxes"]  # [batch_size, num_queries, 4]
-                
-            if not self.freeze_layer2 and not self.freeze_layer3:   
-              out_prob=[out_prob_1, out_prob_2, out_prob_3]
-            
-            if not self.freeze_layer1 and not self.freeze_layer2 and self.freeze_layer3:   
-              out_prob=[out_prob_1, out_prob_2]
-              
-            if self.freeze_layer2 and self.freeze_layer3:   
-              out_prob=[out_prob_1]    
-              
-            if self.freeze_layer1:
-              out_prob= [out_prob_2]
-            
-            indices = []
-            matched_ids = []
-           
-            assert bs == len(targets)
-            for batch_idx in range(bs):
-                bz_boxes = out_bbox[batch_idx]  # [num_proposals, 4]
-                bz_out_prob = []
-                for output_prob in out_prob:
-                  bz_out_prob.append(output_prob[batch_idx])
-                if not self.freeze_layer1:
-                  bz_tgt_ids_1 = targets[batch_idx]["labels_1"]
-                if not self.freeze_layer2:
-                  bz_tgt_ids_2 = targets[batch_idx]["labels_2"]
-                if not self.freeze_layer3:
-                  bz_tgt_ids_3 = targets[batch_idx]["labels_3"]
-                
-                
-                if not self.freeze_layer2 and not self.freeze_layer3:   
-                  bz_tgt_ids=[bz_tgt_ids_1,bz_tgt_ids_2,bz_tgt_ids_3]
-                
-                if not self.freeze_layer1 and not self.freeze_layer2 and self.freeze_layer3:
-                  bz_tgt_ids=[bz_tgt_ids_1,bz_tgt_ids_2]
-                if self.freeze_layer2 and self.freeze_layer3: 
-                  bz_tgt_ids=[bz_tgt_ids_1]      
-                
-                if self.freeze_layer1:
-                  bz_tgt_ids=[bz_tgt_ids_2] 
-                  
-                try:
-                  num_insts= len(bz_tgt_ids_1)
-                except:
-                  num_insts= len(bz_tgt_ids_2)
-
-                if num_insts == 0:  # empty object in key frame
-                    non_valid = torch.zeros(bz_out_prob[0].shape[0]).to(bz_out_prob[0]) > 0
-                    indices_batchi = (non_valid, torch.arange(0, 0).to(bz_out_prob[0]))
-                    matched_qidx = torch.arange(0, 0).to(bz_out_prob[0])
-                    indices.append(indices_batchi)
-                    matched_ids.append(matched_qidx)
-                    continue 
-                    
-                    """
-                    non_valid = []
-                    indices_batchi_input=[]
-                    matched_qidx=[]
-                    
-                    
-                   
-                    for bz_output_prob in bz_out_prob:
-                      non_valid.append(torch.zeros(bz_output_prob.shape[0]).to(bz_output_prob) > 0)
-                    
-                      indices_batchi=(non_valid, torch.arange(0, 0).to(bz_output_prob))
-                      indices_batchi_input.append(indices_batchi)
-                      matched_qidx.append(torch.arange(0, 0).to(bz_output_prob))
-                      
-                    
-                    indices.append(indices_batchi_input)
-                    matched_ids.append(matched_qidx)
-                    continue
-                    """
-                    
-                    
-
-                bz_gtboxs = targets[batch_idx]['boxes']  # [num_gt, 4] normalized (cx, xy, w, h)
-                bz_gtboxs_abs_xyxy = targets[batch_idx]['boxes_xyxy']
-                fg_mask, is_in_boxes_and_center = self.get_in_boxes_info(
-                    box_xyxy_to_cxcywh(bz_boxes),  # absolute (cx, cy, w, h)
-                    box_xyxy_to_cxcywh(bz_gtboxs_abs_xyxy),  # absolute (cx, cy, w, h)
-                    expanded_strides=32
-                )
-
-                pair_wise_ious = ops.box_iou(bz_boxes, bz_gtboxs_abs_xyxy)
-
-                # Compute the classification cost.
-                cost_class=[]
+                out_prob = [outputs["pred_logits_{}".format(l)].softmax(-1) for l in levels]
+
+            num_gts = [len(t["boxes"]) for t in targets]
+            max_gt = max(num_gts)
+            if max_gt == 0:  # empty object in every key frame
+                non_valid = out_bbox.new_zeros(bs, num_queries, dtype=torch.bool)
+                no_match = torch.zeros(0, dtype=torch.long, device=out_bbox.device)
+                return [(non_valid[i], no_match) for i in range(bs)], [no_match] * bs
+            valid = torch.arange(max_gt, device=out_bbox.device) < torch.as_tensor(num_gts, device=out_bbox.device)[:, None]
+            # padded with empty boxes at the origin, which are neither in any box nor in any center region
+            gt_boxes_xyxy = pad_sequence([t["boxes_xyxy"] for t in targets], batch_first=True)  # [batch_size, max_gt, 4]
+            tgt_ids = [pad_sequence([t["labels_{}".format(l)] for t in targets], batch_first=True) for l in levels]
+
+            fg_mask, is_in_boxes_and_center = self.get_in_boxes_info(
+                box_xyxy_to_cxcywh(out_bbox),  # absolute (cx, cy, w, h)
+                box_xyxy_to_cxcywh(gt_boxes_xyxy),  # absolute (cx, cy, w, h)
+                expanded_strides=32
+            )
+
+            pair_wise_ious, _ = box_ops.box_iou(out_bbox, gt_boxes_xyxy)
+
+            # Compute the classification cost.
+            cost_class = []
+            for prob, ids in zip(out_prob, tgt_ids):
+                ids = ids[:, None, :].expand(-1, num_queries, -1)  # [batch_size, num_queries, max_gt]
                 if self.use_focal:
                     alpha = self.focal_loss_alpha
                     gamma = self.focal_loss_gamma
-                    
-                    for i in range(len(bz_out_prob)):
-                      neg_cost_class = (1 - alpha) * (bz_out_prob[i] ** gamma) * (-(1 - bz_out_prob[i] + 1e-8).log())
-                      pos_cost_class = alpha * ((1 - bz_out_prob[i]) ** gamma) * (-(bz_out_prob[i] + 1e-8).log())
-                      cost_class.append(pos_cost_class[:, bz_tgt_ids[i]] - neg_cost_class[:, bz_tgt_ids[i]])
-                      #cost_class_2 = pos_cost_class[:, bz_tgt_ids_2] - neg_cost_class[:, bz_tgt_ids_2]
-                      #cost_class_3 = pos_cost_class[:, bz_tgt_ids_3] - neg_cost_class[:, bz_tgt_ids_3]
+                    neg_cost_class = (1 - alpha) * (prob ** gamma) * (-(1 - prob + 1e-8).log())
+                    pos_cost_class = alpha * ((1 - prob) ** gamma) * (-(prob + 1e-8).log())
+                    cost_class.append(pos_cost_class.gather(2, ids) - neg_cost_class.gather(2, ids))
                 elif self.use_fed_loss:
                     # focal loss degenerates to naive one
-                    for i in range(len(bz_out_prob)):
-                      neg_cost_class = (-(1 - bz_out_prob[i] + 1e-8).log())
-                      pos_cost_class = (-(bz_out_pro[i] + 1e-8).log())
-                      #cost_class = pos_cost_class[:, bz_tgt_ids] - neg_cost_class[:, bz_tgt_ids]
-                      
-                      cost_class.append(pos_cost_class[:, bz_tgt_ids[i]] - neg_cost_class[:, bz_tgt_ids[i]])
-                    #cost_class_2 = pos_cost_class[:, bz_tgt_ids_2] - neg_cost_class[:, bz_tgt_ids_2]
-                    #cost_class_3 = pos_cost_class[:, bz_tgt_ids_3] - neg_cost_class[:, bz_tgt_ids_3]
+                    neg_cost_class = (-(1 - prob + 1e-8).log())
+                    pos_cost_class = (-(prob + 1e-8).log())
+                    cost_class.append(pos_cost_class.gather(2, ids) - neg_cost_class.gather(2, ids))
                 else:
-                    #cost_class = -bz_out_prob[:, bz_tgt_ids]
-                    for i in range(len(bz_out_prob)):
-                      cost_class.append(-bz_out_prob[i][:, bz_tgt_ids[i]])
-                    #cost_class_2 = -bz_out_prob[:, bz_tgt_ids_2]
-                    #cost_class_3 = -bz_out_prob[:, bz_tgt_ids_3]
-                   
-
-                # Compute the L1 cost between boxes
-                # image_size_out = torch.cat([v["image_size_xyxy"].unsqueeze(0) for v in targets])
-                # image_size_out = image_size_out.unsqueeze(1).repeat(1, num_queries, 1).flatten(0, 1)
-                # image_size_tgt = torch.cat([v["image_size_xyxy_tgt"] for v in targets])
+                    cost_class.append(-prob.gather(2, ids))
 
-                bz_image_size_out = targets[batch_idx]['image_size_xyxy']
-                bz_image_size_tgt = targets[batch_idx]['image_size_xyxy_tgt']
+            # Compute the L1 cost between boxes
+            image_size_xyxy = torch.stack([t["image_size_xyxy"] for t in targets])[:, None, :]
+            out_bbox_ = out_bbox / image_size_xyxy  # normalize (x1, y1, x2, y2)
+            tgt_bbox_ = gt_boxes_xyxy / image_size_xyxy  # normalize (x1, y1, x2, y2)
+            cost_bbox = torch.cdist(out_bbox_, tgt_bbox_, p=1)
 
-                bz_out_bbox_ = bz_boxes / bz_image_size_out  # normalize (x1, y1, x2, y2)
-                bz_tgt_bbox_ = bz_gtboxs_abs_xyxy / bz_image_size_tgt  # normalize (x1, y1, x2, y2)
-                cost_bbox = torch.cdist(bz_out_bbox_, bz_tgt_bbox_, p=1)
+            cost_giou = -generalized_box_iou(out_bbox, gt_boxes_xyxy)
 
-                cost_giou = -generalized_box_iou(bz_boxes, bz_gtboxs_abs_xyxy)
-
-                # Final cost matrix
-               
-               
-               
-                length = len(bz_tgt_ids)
-                self.cost_class=1/length
-                if not self.freeze_layer2 and not self.freeze_layer3:   
-                  cost = self.cost_bbox * cost_bbox +  self.cost_class * cost_class[0] +  self.cost_class * cost_class[1] +  self.cost_class * cost_class[2] + self.cost_giou * cost_giou + 100.0 * (~is_in_boxes_and_center)  
-                  
-                  
-                if not self. freeze_layer1 and not self.freeze_layer2 and self.freeze_layer3:   
-                  cost = self.cost_bbox * cost_bbox +  self.cost_class * cost_class[0] +  self.cost_class * cost_class[1] + self.cost_giou * cost_giou + 100.0 * (~is_in_boxes_and_center)
-                  
-                    
-                  
-                  
-                if self.freeze_layer2 and self.freeze_layer3:   
-                  cost = self.cost_bbox * cost_bbox +  self.cost_class * cost_class[0] + self.cost_giou * cost_giou + 100.0 * (~is_in_boxes_and_center)   
-                  
-                  
-                if self.freeze_layer1:   
-                  cost = self.cost_bbox * cost_bbox +  self.cost_class * cost_class[0] + self.cost_giou * cost_giou + 100.0 * (~is_in_boxes_and_center)      
-                # cost = (cost_class + 3.0 * cost_giou + 100.0 * (~is_in_boxes_and_center))  # [num_query,num_gt]
-                cost[~fg_mask] = cost[~fg_mask] + 10000.0
-                
-                
+            # Final cost matrix
+            self.cost_class = 1 / len(levels)
+            cost = self.cost_bbox * cost_bbox
+            for level_cost_class in cost_class:
+                cost = cost + self.cost_class * level_cost_class
+            cost = cost + self.cost_giou * cost_giou + 100.0 * (~is_in_boxes_and_center)  # [batch_size, num_query, max_gt]
+            cost = torch.where(fg_mask[:, :, None], cost, cost + 10000.0)
+            cost = cost.masked_fill(~valid[:, None, :], float('inf'))
 
-                # if bz_gtboxs.shape[0]>0:
-                indices_batchi, matched_qidx = self.dynamic_k_matching(cost, pair_wise_ious, bz_gtboxs.shape[0])
+            selected_query, gt_indices, matched_query_id = self.dynamic_k_matching(cost, pair_wise_ious, valid)
 
-                indices.append(indices_batchi)
-                matched_ids.append(matched_qidx)
+            gt_indices = gt_indices[selected_query].split(selected_query.sum(1).tolist())
+            indices = [(selected_query[i], gt_indices[i]) for i in range(bs)]
+            matched_ids = [matched_query_id[i, :num_gts[i]] for i in range(bs)]
 
         return indices, matched_ids
 
     def get_in_boxes_info(self, boxes, target_gts, expanded_strides):
         xy_target_gts = box_cxcywh_to_xyxy(target_gts)  # (x1, y1, x2, y2)
 
-        anchor_center_x = boxes[:, 0].unsqueeze(1)
-        anchor_center_y = boxes[:, 1].unsqueeze(1)
+        anchor_center_x = boxes[..., 0].unsqueeze(-1)
+        anchor_center_y = boxes[..., 1].unsqueeze(-1)
 
         # whether the center of each anchor is inside a gt box
-        b_l = anchor_center_x > xy_target_gts[:, 0].unsqueeze(0)
-        b_r = anchor_center_x < xy_target_gts[:, 2].unsqueeze(0)
-        b_t = anchor_center_y > xy_target_gts[:, 1].unsqueeze(0)
-        b_b = anchor_center_y < xy_target_gts[:, 3].unsqueeze(0)
+        b_l = anchor_center_x > xy_target_gts[..., 0].unsqueeze(-2)
+        b_r = anchor_center_x < xy_target_gts[..., 2].unsqueeze(-2)
+        b_t = anchor_center_y > xy_target_gts[..., 1].unsqueeze(-2)
+        b_b = anchor_center_y < xy_target_gts[..., 3].unsqueeze(-2)
         # (b_l.long()+b_r.long()+b_t.long()+b_b.long())==4 [300,num_gt] ,
         is_in_boxes = ((b_l.long() + b_r.long() + b_t.long() + b_b.long()) == 4)
-        is_in_boxes_all = is_in_boxes.sum(1) > 0  # [num_query]
+        is_in_boxes_all = is_in_boxes.sum(-1) > 0  # [num_query]
         # in fixed center
         center_radius = 2.5
         # Modified to self-adapted sampling --- the center size depends on the size of the gt boxes
         # https://github.com/dulucas/UVO_Challenge/blob/main/Track1/detection/mmdet/core/bbox/assigners/rpn_sim_ota_assigner.py#L212
-        b_l = anchor_center_x > (target_gts[:, 0] - (center_radius * (xy_target_gts[:, 2] - xy_target_gts[:, 0]))).unsqueeze(0)
-        b_r = anchor_center_x < (target_gts[:, 0] + (center_radius * (xy_target_gts[:, 2] - xy_target_gts[:, 0]))).unsqueeze(0)
-        b_t = anchor_center_y > (target_gts[:, 1] - (center_radius * (xy_target_gts[:, 3] - xy_target_gts[:, 1]))).unsqueeze(0)
-        b_b = anchor_center_y < (target_gts[:, 1] + (center_radius * (xy_target_gts[:, 3] - xy_target_gts[:, 1]))).unsqueeze(0)
+        b_l = anchor_center_x > (target_gts[..., 0] - (center_radius * (xy_target_gts[..., 2] - xy_target_gts[..., 0]))).unsqueeze(-2)
+        b_r = anchor_center_x < (target_gts[..., 0] + (center_radius * (xy_target_gts[..., 2] - xy_target_gts[..., 0]))).unsqueeze(-2)
+        b_t = anchor_center_y > (target_gts[..., 1] - (center_radius * (xy_target_gts[..., 3] - xy_target_gts[..., 1]))).unsqueeze(-2)
+        b_b = anchor_center_y < (target_gts[..., 1] + (center_radius * (xy_target_gts[..., 3] - xy_target_gts[..., 1]))).unsqueeze(-2)
 
         is_in_centers = ((b_l.long() + b_r.long() + b_t.long() + b_b.long()) == 4)
-        is_in_centers_all = is_in_centers.sum(1) > 0
+        is_in_centers_all = is_in_centers.sum(-1) > 0
 
         is_in_boxes_anchor = is_in_boxes_all | is_in_centers_all
         is_in_boxes_and_center = (is_in_boxes & is_in_centers)
 
         return is_in_boxes_anchor, is_in_boxes_and_center
 
-    def dynamic_k_matching(self, cost, pair_wise_ious, num_gt):
-        matching_matrix = torch.zeros_like(cost)  # [300,num_gt]
-        ious_in_boxes_matrix = pair_wise_ious
+    def dynamic_k_matching(self, cost, pair_wise_ious, valid):
+        """
+        Args:
+            cost (Tensor): [batch_size, num_query, max_gt], inf for the padded targets.
+            pair_wise_ious (Tensor): [batch_size, num_query, max_gt].
+            valid (Tensor): [batch_size, max_gt], False for the padded targets.
+
+        Returns:
+            selected_query (Tensor): [batch_size, num_query], whether a query is matched.
+            gt_indices (Tensor): [batch_size, num_query], the target of each matched query.
+            matched_query_id (Tensor): [batch_size, max_gt], the best matched query of each target.
+        """
         n_candidate_k = self.ota_k
 
         # Take the sum of the predicted value and the top 10 iou of gt with the largest iou as dynamic_k
-        topk_ious, _ = torch.topk(ious_in_boxes_matrix, n_candidate_k, dim=0)
-        dynamic_ks = torch.clamp(topk_ious.sum(0).int(), min=1)
-
-        for gt_idx in range(num_gt):
-            _, pos_idx = torch.topk(cost[:, gt_idx], k=dynamic_ks[gt_idx].item(), largest=False)
-            matching_matrix[:, gt_idx][pos_idx] = 1.0
-
-        del topk_ious, dynamic_ks, pos_idx
-
-        anchor_matching_gt = matching_matrix.sum(1)
-
-        if (anchor_matching_gt > 1).sum() > 0:
-            _, cost_argmin = torch.min(cost[anchor_matching_gt > 1], dim=1)
-            matching_matrix[anchor_matching_gt > 1] *= 0
-            matching_matrix[anchor_matching_gt > 1, cost_argmin,] = 1
-
-        while (matching_matrix.sum(0) == 0).any():
-            num_zero_gt = (matching_matrix.sum(0) == 0).sum()
-            matched_query_id = matching_matrix.sum(1) > 0
-            cost[matched_query_id] += 100000.0
-            unmatch_id = torch.nonzero(matching_matrix.sum(0) == 0, as_tuple=False).squeeze(1)
-            for gt_idx in unmatch_id:
-                pos_idx = torch.argmin(cost[:, gt_idx])
-                matching_matrix[:, gt_idx][pos_idx] = 1.0
-            if (matching_matrix.sum(1) > 1).sum() > 0:  # If a query matches more than one gt
-                _, cost_argmin = torch.min(cost[anchor_matching_gt > 1],
-                                           dim=1)  # find gt for these queries with minimal cost
-                matching_matrix[anchor_matching_gt > 1] *= 0  # reset mapping relationship
-                matching_matrix[anchor_matching_gt > 1, cost_argmin,] = 1  # keep gt with minimal cost
-
-        assert not (matching_matrix.sum(0) == 0).any()
-        selected_query = matching_matrix.sum(1) > 0
-        gt_indices = matching_matrix[selected_query].max(1)[1]
-        assert selected_query.sum() == len(gt_indices)
-
-        cost[matching_matrix == 0] = cost[matching_matrix == 0] + float('inf')
-        matched_query_id = torch.min(cost, dim=0)[1]
-
-        return (selected_query, gt_indices), matched_query_id
+        topk_ious, _ = torch.topk(pair_wise_ious, n_candidate_k, dim=1)
+        dynamic_ks = torch.clamp(topk_ious.sum(1).int(), min=1)  # [batch_size, max_gt], at most n_candidate_k
+
+        # each gt takes its dynamic_k lowest-cost queries
+        _, pos_idx = torch.topk(cost, n_candidate_k, dim=1, largest=False)
+        rank = torch.arange(n_candidate_k, device=cost.device)[None, :, None]
+        matching_matrix = torch.zeros_like(cost).scatter_(1, pos_idx, ((rank < dynamic_ks[:, None, :]) & valid[:, None, :]).to(cost))
+
+        # a query matched to several gts keeps the gt with the lowest cost
+        anchor_matching_gt = matching_matrix.sum(2, keepdim=True)
+        cost_argmin = torch.zeros_like(cost).scatter_(2, cost.argmin(2, keepdim=True), 1.0)
+        matching_matrix = torch.where(anchor_matching_gt > 1, cost_argmin, matching_matrix)
+
+        # a gt left without a query takes its lowest-cost query among the unmatched ones
+        unmatched_gt = (matching_matrix.sum(1, keepdim=True) == 0) & valid[:, None, :]
+        has_unmatched_gt = unmatched_gt.any(2, keepdim=True)
+        cost = torch.where(has_unmatched_gt & (matching_matrix.sum(2, keepdim=True) > 0), cost + 100000.0, cost)
+        pos_idx = cost.argmin(1, keepdim=True)
+        matching_matrix = torch.maximum(matching_matrix, torch.zeros_like(cost).scatter_(1, pos_idx, unmatched_gt.to(cost)))
+
+        selected_query = matching_matrix.sum(2) > 0
+        gt_indices = matching_matrix.argmax(2)
+
+        cost = cost.masked_fill(matching_matrix == 0, float('inf'))
+        matched_query_id = torch.min(cost, dim=1)[1]
+
+        return selected_query, gt_indices, matched_query_id
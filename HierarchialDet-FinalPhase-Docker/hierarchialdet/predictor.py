@@ -2,7 +2,10 @@
 import atexit
 import bisect
 import multiprocessing as mp
+import queue
+import threading
 from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import cv2
 import torch
 
@@ -49,12 +52,7 @@ class VisualizationDemo(object):
             vis_output (VisImage): the visualized image output.
         """
         vis_output = None
-        predictions = self.predictor(image)
-        # Filter
-        instances = predictions['instances']
-      
-        new_instances = instances[instances.scores > self.threshold]
-        predictions = {'instances': new_instances}
+        predictions = {"instances": self.predict(image)}
         # Convert image from OpenCV BGR format to Matplotlib RGB format.
         image = image[:, :, ::-1]  
         visualizer = Visualizer(image, self.metadata, instance_mode=self.instance_mode)
@@ -75,6 +73,62 @@ class VisualizationDemo(object):
 
         return predictions, vis_output
 
+    def predict(self, image):
+        """
+        Runs the model on one image without building a :class:`Visualizer`
+        or copying the image.
+
+        Args:
+            image (np.ndarray): an image of shape (H, W, C) (in BGR order).
+
+        Returns:
+            Instances: the predictions scoring above the score threshold.
+        """
+        return self._filter(self.predictor(image))["instances"]
+
+    def run_on_images(self, images, batch_size=1, num_workers=0):
+        """
+        Runs the model on mini-batches of images. Nothing is visualized.
+
+        Args:
+            images (iterable[np.ndarray]): images of shape (H, W, C) (in BGR order).
+            batch_size (int): number of images pushed through the model at once.
+            num_workers (int): if > 0, the images are read from `images` in a background
+                thread and resized by a pool of this many threads while the model runs
+                on the current batch.
+
+        Yields:
+            predictions (dict): the output of the model for each image, in input order.
+        """
+        if self.parallel:
+            for image in images:
+                yield self._filter(self.predictor(image))
+            return
+
+        pool = None
+        if num_workers > 0:
+            pool = ThreadPoolExecutor(num_workers)
+            inputs = _bounded_map(self.predictor.preprocess, images, pool, 2 * batch_size)
+        else:
+            inputs = map(self.predictor.preprocess, images)
+        try:
+            batch = []
+            for image_input in inputs:
+                batch.append(image_input)
+                if len(batch) == batch_size:
+                    yield from map(self._filter, self.predictor.predict_inputs(batch))
+                    batch = []
+            if len(batch):
+                yield from map(self._filter, self.predictor.predict_inputs(batch))
+        finally:
+            if pool is not None:
+                inputs.close()
+                pool.shutdown(wait=False)
+
+    def _filter(self, predictions):
+        instances = predictions["instances"]
+        return dict(predictions, instances=instances[instances.scores > self.threshold])
+
     def _frame_from_video(self, video):
         while video.isOpened():
             success, frame = video.read()
@@ -228,3 +282,65 @@ class AsyncPredictor:
     @property
     def default_buffer_size(self):
         return len(self.procs) * 5
+
+
+def _bounded_map(func, iterable, pool, maxsize):
+    """
+    Like `pool.map(func, iterable)`, but `iterable` is consumed in a background thread
+    and at most `maxsize` results are pending at any time, so a long generator is not
+    read ahead of the consumer.
+
+    If the consumer stops early, the background thread stops reading, closes the
+    iterator and is joined, and the calls that have not started are cancelled.
+
+    Yields:
+        the results of `func`, in input order.
+    """
+    pending = queue.Queue(maxsize=maxsize)
+    done = object()
+    stopped = threading.Event()
+
+    def put(item):
+        # poll instead of blocking, so that a stopped consumer never leaves us waiting on a full queue
+        while not stopped.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        items = None
+        try:
+            items = iter(iterable)
+            for item in items:
+                future = pool.submit(func, item)
+                if not put(future):
+                    future.cancel()
+                    return
+        except BaseException as e:
+            failed = Future()
+            failed.set_exception(e)
+            put(failed)
+        finally:
+            close = getattr(items, "close", None)
+            if close is not None:
+                close()
+        put(done)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            future = pending.get()
+            if future is done:
+                break
+            yield future.result()
+    finally:
+        stopped.set()
+        thread.join()
+        while not pending.empty():
+            future = pending.get_nowait()
+            if future is not done:
+                future.cancel()
@@ -8,6 +8,10 @@
 # Copyright (c) Facebook, Inc. and its affiliates.
 # Modified by Xingyi Zhou from https://github.com/SwinTransformer/Swin-Transformer-Object-Detection/blob/master/mmdet/models/backbones/swin_transformer.py
 
+import functools
+import logging
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -79,6 +83,41 @@ def window_partition(x, window_size):
     return windows
 
 
+@functools.lru_cache(maxsize=32)
+def shifted_window_attention_mask(Hp, Wp, window_size, shift_size, device):
+    """
+    Attention mask for SW-MSA, cached since the input sizes repeat.
+    Args:
+        Hp, Wp (int): Padded height and width of the feature map, multiples of window_size
+        window_size (int): Window size
+        shift_size (int): Shift size of the cyclic shift
+        device (torch.device): Device of the mask
+    Returns:
+        attn_mask: (num_windows, window_size*window_size, window_size*window_size), 0 or -100.
+            Shared between calls, it must not be modified in place.
+    """
+    # a mask created in inference mode could not be used by later training passes
+    with torch.inference_mode(False):
+        img_mask = torch.zeros((1, Hp, Wp, 1), device=device)  # 1 Hp Wp 1
+        h_slices = (slice(0, -window_size),
+                    slice(-window_size, -shift_size),
+                    slice(-shift_size, None))
+        w_slices = (slice(0, -window_size),
+                    slice(-window_size, -shift_size),
+                    slice(-shift_size, None))
+        cnt = 0
+        for h in h_slices:
+            for w in w_slices:
+                img_mask[:, h, w, :] = cnt
+                cnt += 1
+
+        mask_windows = window_partition(img_mask, window_size)  # nW, window_size, window_size, 1
+        mask_windows = mask_windows.view(-1, window_size * window_size)
+        attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
+        attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+    return attn_mask
+
+
 def window_reverse(windows, window_size, H, W):
     """
     Args:
@@ -106,9 +145,12 @@ class WindowAttention(nn.Module):
         qk_scale (float | None, optional): Override default qk scale of head_dim ** -0.5 if set
         attn_drop (float, optional): Dropout ratio of attention weight. Default: 0.0
         proj_drop (float, optional): Dropout ratio of output. Default: 0.0
+        fused_attn (bool, optional): If True, compute the attention with
+            F.scaled_dot_product_attention when this version of torch provides it. Default: False
     """
 
-    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.,
+                 fused_attn=False):
 
         super().__init__()
         self.dim = dim
@@ -142,6 +184,38 @@ class WindowAttention(nn.Module):
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
 
+        self.fused_attn = fused_attn and hasattr(F, "scaled_dot_product_attention")
+        # F.scaled_dot_product_attention scales by head_dim ** -0.5, q is rescaled for any other qk_scale
+        self.fused_q_scale = self.scale * head_dim ** 0.5
+        self._bias_cache = None
+        self._bias_cache_key = None
+
+    def relative_position_bias(self):
+        """
+        Gather the relative position bias of every head from the table.
+        Outside of training, the result is kept until the table is modified or moved.
+
+        Returns:
+            Tensor: bias of shape (num_heads, Wh*Ww, Wh*Ww).
+        """
+        table = self.relative_position_bias_table
+        if self.training or (torch.is_grad_enabled() and table.requires_grad):
+            return self._gather_relative_position_bias()
+
+        key = (table.data_ptr(), table._version, table.dtype)
+        if key != self._bias_cache_key:
+            # inference_mode(False) re-enables grad, hence the explicit no_grad
+            with torch.inference_mode(False), torch.no_grad():
+                self._bias_cache = self._gather_relative_position_bias()
+            self._bias_cache_key = key
+        return self._bias_cache
+
+    def _gather_relative_position_bias(self):
+        N = self.window_size[0] * self.window_size[1]
+        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
+            N, N, -1)  # Wh*Ww,Wh*Ww,nH
+        return relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+
     def forward(self, x, mask=None):
         """ Forward function.
         Args:
@@ -152,12 +226,12 @@ class WindowAttention(nn.Module):
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
+        relative_position_bias = self.relative_position_bias()
+        if self.fused_attn:
+            return self._fused_forward(q, k, v, relative_position_bias, mask)
+
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1))
-
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
         attn = attn + relative_position_bias.unsqueeze(0)
 
         if mask is not None:
@@ -175,6 +249,34 @@ class WindowAttention(nn.Module):
         x = self.proj_drop(x)
         return x
 
+    def _fused_forward(self, q, k, v, relative_position_bias, mask):
+        """
+        Same as the explicit path of :meth:`forward`, with the relative position bias and
+        the shift mask merged into one additive mask for F.scaled_dot_product_attention.
+        """
+        B_, nH, N, head_dim = q.shape
+        dropout_p = self.attn_drop.p if self.training else 0.
+        if not math.isclose(self.fused_q_scale, 1.):
+            q = q * self.fused_q_scale
+        if mask is None:
+            attn_mask = relative_position_bias.unsqueeze(0).to(q.dtype)  # 1, nH, N, N
+            x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+        else:
+            # the mask is merged with the bias once per window and shared by all images:
+            # each image's (nW, nH, N, head_dim) windows are attended with the same
+            # (nW, nH, N, N) mask, so it is never repeated over the batch
+            nW = mask.shape[0]
+            attn_mask = (mask.unsqueeze(1) + relative_position_bias.unsqueeze(0)).to(q.dtype)
+            q, k, v = (t.view(B_ // nW, nW, nH, N, head_dim) for t in (q, k, v))
+            x = torch.stack([
+                F.scaled_dot_product_attention(q_i, k_i, v_i, attn_mask=attn_mask, dropout_p=dropout_p)
+                for q_i, k_i, v_i in zip(q, k, v)
+            ]).view(B_, nH, N, head_dim)
+        x = x.transpose(1, 2).reshape(B_, N, nH * head_dim)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
 
 class SwinTransformerBlock(nn.Module):
     """ Swin Transformer Block.
@@ -191,11 +293,12 @@ class SwinTransformerBlock(nn.Module):
         drop_path (float, optional): Stochastic depth rate. Default: 0.0
         act_layer (nn.Module, optional): Activation layer. Default: nn.GELU
         norm_layer (nn.Module, optional): Normalization layer.  Default: nn.LayerNorm
+        fused_attn (bool, optional): Use F.scaled_dot_product_attention when available. Default: False
     """
 
     def __init__(self, dim, num_heads, window_size=7, shift_size=0,
                  mlp_ratio=4., qkv_bias=True, qk_scale=None, drop=0., attn_drop=0., drop_path=0.,
-                 act_layer=nn.GELU, norm_layer=nn.LayerNorm):
+                 act_layer=nn.GELU, norm_layer=nn.LayerNorm, fused_attn=False):
         super().__init__()
         self.dim = dim
         self.num_heads = num_heads
@@ -207,7 +310,8 @@ class SwinTransformerBlock(nn.Module):
         self.norm1 = norm_layer(dim)
         self.attn = WindowAttention(
             dim, window_size=to_2tuple(self.window_size), num_heads=num_heads,
-            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop,
+            fused_attn=fused_attn)
 
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
@@ -333,6 +437,7 @@ class BasicLayer(nn.Module):
         norm_layer (nn.Module, optional): Normalization layer. Default: nn.LayerNorm
         downsample (nn.Module | None, optional): Downsample layer at the end of the layer. Default: None
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False.
+        fused_attn (bool): Use F.scaled_dot_product_attention when available. Default: False.
     """
 
     def __init__(self,
@@ -348,7 +453,8 @@ class BasicLayer(nn.Module):
                  drop_path=0.,
                  norm_layer=nn.LayerNorm,
                  downsample=None,
-                 use_checkpoint=False):
+                 use_checkpoint=False,
+                 fused_attn=False):
         super().__init__()
         self.window_size = window_size
         self.shift_size = window_size // 2
@@ -368,7 +474,8 @@ class BasicLayer(nn.Module):
                 drop=drop,
                 attn_drop=attn_drop,
                 drop_path=drop_path[i] if isinstance(drop_path, list) else drop_path,
-                norm_layer=norm_layer)
+                norm_layer=norm_layer,
+                fused_attn=fused_attn)
             for i in range(depth)])
 
         # patch merging layer
@@ -387,23 +494,7 @@ class BasicLayer(nn.Module):
         # calculate attention mask for SW-MSA
         Hp = int(np.ceil(H / self.window_size)) * self.window_size
         Wp = int(np.ceil(W / self.window_size)) * self.window_size
-        img_mask = torch.zeros((1, Hp, Wp, 1), device=x.device)  # 1 Hp Wp 1
-        h_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        w_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        cnt = 0
-        for h in h_slices:
-            for w in w_slices:
-                img_mask[:, h, w, :] = cnt
-                cnt += 1
-
-        mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
-        mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-        attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-        attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+        attn_mask = shifted_window_attention_mask(Hp, Wp, self.window_size, self.shift_size, x.device)
 
         for blk in self.blocks:
             blk.H, blk.W = H, W
@@ -426,9 +517,12 @@ class PatchEmbed(nn.Module):
         in_chans (int): Number of input image channels. Default: 3.
         embed_dim (int): Number of linear projection output channels. Default: 96.
         norm_layer (nn.Module, optional): Normalization layer. Default: None
+        fold_to_gray (tuple[list[float]] | None, optional): The (pixel_mean, pixel_std) the input
+            channels are normalized with. If set, the embedding takes single-channel images normalized
+            with the mean of pixel_mean and of pixel_std, and the projection is folded to match. Default: None
     """
 
-    def __init__(self, patch_size=4, in_chans=3, embed_dim=96, norm_layer=None):
+    def __init__(self, patch_size=4, in_chans=3, embed_dim=96, norm_layer=None, fold_to_gray=None):
         super().__init__()
         patch_size = to_2tuple(patch_size)
         self.patch_size = patch_size
@@ -442,6 +536,43 @@ class PatchEmbed(nn.Module):
         else:
             self.norm = None
 
+        self.fold_to_gray = fold_to_gray is not None
+        if self.fold_to_gray:
+            pixel_mean, pixel_std = fold_to_gray
+            assert len(pixel_mean) == len(pixel_std) == in_chans
+            self.register_buffer("fold_pixel_mean", torch.tensor(pixel_mean).view(1, -1, 1, 1), persistent=False)
+            self.register_buffer("fold_pixel_std", torch.tensor(pixel_std).view(1, -1, 1, 1), persistent=False)
+        self._gray_cache = None
+        self._gray_cache_key = None
+
+    def gray_projection(self):
+        """
+        Fold the projection over the input channels. With the channels normalized as
+        (x - mean_c) / std_c and the single channel as (x - mean) / std, where mean and
+        std are the means of mean_c and std_c, the folded projection of a gray image gives
+        the same output as the original projection of that image repeated on every channel.
+        Outside of training, the result is kept until the projection is modified or moved.
+
+        Returns:
+            weight (Tensor): of shape (embed_dim, 1, patch_h, patch_w).
+            bias (Tensor): of shape (embed_dim,).
+        """
+        weight, bias = self.proj.weight, self.proj.bias
+        cacheable = not self.training and not (torch.is_grad_enabled() and weight.requires_grad)
+        key = tuple((p.data_ptr(), p._version, p.dtype) for p in (weight, bias))
+        if cacheable and key == self._gray_cache_key:
+            return self._gray_cache
+
+        weight = weight / self.fold_pixel_std
+        gray_weight = weight.sum(1, keepdim=True)
+        gray_bias = (bias + gray_weight.sum((1, 2, 3)) * self.fold_pixel_mean.mean()
+                     - (weight * self.fold_pixel_mean).sum((1, 2, 3)))
+        gray_weight = gray_weight * self.fold_pixel_std.mean()
+        if cacheable:
+            self._gray_cache = (gray_weight, gray_bias)
+            self._gray_cache_key = key
+        return gray_weight, gray_bias
+
     def forward(self, x):
         """Forward function."""
         # padding
@@ -451,7 +582,11 @@ class PatchEmbed(nn.Module):
         if H % self.patch_size[0] != 0:
             x = F.pad(x, (0, 0, 0, self.patch_size[0] - H % self.patch_size[0]))
 
-        x = self.proj(x)  # B C Wh Ww
+        if self.fold_to_gray:
+            weight, bias = self.gray_projection()
+            x = F.conv2d(x, weight, bias, stride=self.patch_size)  # B C Wh Ww
+        else:
+            x = self.proj(x)  # B C Wh Ww
         if self.norm is not None:
             Wh, Ww = x.size(2), x.size(3)
             x = x.flatten(2).transpose(1, 2)
@@ -487,6 +622,9 @@ class SwinTransformer(Backbone):
         frozen_stages (int): Stages to be frozen (stop grad and set eval mode).
             -1 means not freezing any parameters.
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False.
+        fused_attn (bool): Use F.scaled_dot_product_attention when available. Default: False.
+        fold_to_gray (tuple[list[float]] | None): The (pixel_mean, pixel_std) of the input channels,
+            to take single-channel images instead. See :class:`PatchEmbed`. Default: None.
     """
 
     def __init__(self,
@@ -508,7 +646,9 @@ class SwinTransformer(Backbone):
                  patch_norm=True,
                  out_indices=(0, 1, 2, 3),
                  frozen_stages=-1,
-                 use_checkpoint=False):
+                 use_checkpoint=False,
+                 fused_attn=False,
+                 fold_to_gray=None):
         super().__init__()
 
         self.pretrain_img_size = pretrain_img_size
@@ -519,10 +659,15 @@ class SwinTransformer(Backbone):
         self.out_indices = out_indices
         self.frozen_stages = frozen_stages
 
+        if fused_attn and not hasattr(F, "scaled_dot_product_attention"):
+            logging.getLogger(__name__).warning(
+                "fused_attn is set, but torch {} has no F.scaled_dot_product_attention (torch>=2.0). "
+                "The attention is computed explicitly.".format(torch.__version__))
+
         # split image into non-overlapping patches
         self.patch_embed = PatchEmbed(
             patch_size=patch_size, in_chans=in_chans, embed_dim=embed_dim,
-            norm_layer=norm_layer if self.patch_norm else None)
+            norm_layer=norm_layer if self.patch_norm else None, fold_to_gray=fold_to_gray)
 
         # absolute position embedding
         if self.ape:
@@ -554,7 +699,8 @@ class SwinTransformer(Backbone):
                 drop_path=dpr[sum(depths[:i_layer]):sum(depths[:i_layer + 1])],
                 norm_layer=norm_layer,
                 downsample=PatchMerging if (i_layer < self.num_layers - 1) else None,
-                use_checkpoint=use_checkpoint)
+                use_checkpoint=use_checkpoint,
+                fused_attn=fused_attn)
             self.layers.append(layer)
 
         num_features = [int(embed_dim * 2 ** i) for i in range(self.num_layers)]
@@ -727,7 +873,9 @@ def build_swintransformer_backbone(cfg, input_shape):
         drop_path_rate=config['drop_path_rate'],
         out_indices=out_indices,
         frozen_stages=-1,
-        use_checkpoint=cfg.MODEL.SWIN.USE_CHECKPOINT
+        use_checkpoint=cfg.MODEL.SWIN.USE_CHECKPOINT,
+        fused_attn=cfg.MODEL.SWIN.FUSED_ATTENTION,
+        fold_to_gray=(cfg.MODEL.PIXEL_MEAN, cfg.MODEL.PIXEL_STD) if cfg.INPUT.FORMAT == "L" else None,
     )
     # print('Initializing', config['pretrained'])
     model.init_weights(config['pretrained'])
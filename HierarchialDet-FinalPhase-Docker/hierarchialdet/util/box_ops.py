@@ -3,7 +3,6 @@
 Utilities for bounding box manipulation and GIoU.
 """
 import torch
-from torchvision.ops.boxes import box_area
 
 
 def box_cxcywh_to_xyxy(x):
@@ -20,18 +19,22 @@ def box_xyxy_to_cxcywh(x):
     return torch.stack(b, dim=-1)
 
 
-# modified from torchvision to also return the union
+def box_area(boxes):
+    return (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+
+
+# modified from torchvision to also return the union, and to accept batches of box sets
 def box_iou(boxes1, boxes2):
     area1 = box_area(boxes1)
     area2 = box_area(boxes2)
 
-    lt = torch.max(boxes1[:, None, :2], boxes2[:, :2])  # [N,M,2]
-    rb = torch.min(boxes1[:, None, 2:], boxes2[:, 2:])  # [N,M,2]
+    lt = torch.max(boxes1[..., :, None, :2], boxes2[..., None, :, :2])  # [...,N,M,2]
+    rb = torch.min(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:])  # [...,N,M,2]
 
-    wh = (rb - lt).clamp(min=0)  # [N,M,2]
-    inter = wh[:, :, 0] * wh[:, :, 1]  # [N,M]
+    wh = (rb - lt).clamp(min=0)  # [...,N,M,2]
+    inter = wh[..., 0] * wh[..., 1]  # [...,N,M]
 
-    union = area1[:, None] + area2 - inter
+    union = area1[..., :, None] + area2[..., None, :] - inter
 
     iou = inter / union
     return iou, union
@@ -44,19 +47,20 @@ def generalized_box_iou(boxes1, boxes2):
     The boxes should be in [x0, y0, x1, y1] format
 
     Returns a [N, M] pairwise matrix, where N = len(boxes1)
-    and M = len(boxes2)
+    and M = len(boxes2). Batches of box sets of shape [..., N, 4] and
+    [..., M, 4] give a [..., N, M] matrix.
     """
     # degenerate boxes gives inf / nan results
     # so do an early check
-    assert (boxes1[:, 2:] >= boxes1[:, :2]).all()
-    assert (boxes2[:, 2:] >= boxes2[:, :2]).all()
+    assert (boxes1[..., 2:] >= boxes1[..., :2]).all()
+    assert (boxes2[..., 2:] >= boxes2[..., :2]).all()
     iou, union = box_iou(boxes1, boxes2)
 
-    lt = torch.min(boxes1[:, None, :2], boxes2[:, :2])
-    rb = torch.max(boxes1[:, None, 2:], boxes2[:, 2:])
+    lt = torch.min(boxes1[..., :, None, :2], boxes2[..., None, :, :2])
+    rb = torch.max(boxes1[..., :, None, 2:], boxes2[..., None, :, 2:])
 
-    wh = (rb - lt).clamp(min=0)  # [N,M,2]
-    area = wh[:, :, 0] * wh[:, :, 1]
+    wh = (rb - lt).clamp(min=0)  # [...,N,M,2]
+    area = wh[..., 0] * wh[..., 1]
 
     return iou - (area - union) / area
 
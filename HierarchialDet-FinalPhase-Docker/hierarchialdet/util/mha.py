@@ -0,0 +1,203 @@
+"""
+Streaming reader for MetaImage (.mha/.mhd) image stacks.
+
+Only the header is parsed up front; the pixel data is read in bounded chunks and
+one slice at a time is handed out, so the whole stack is never decoded into memory.
+Compressed or multi-file data falls back to a full SimpleITK read.
+"""
+import os
+
+import numpy as np
+
+# read size of the row blocks that interleaved slices are gathered from
+_ROW_BLOCK_BYTES = 1 << 24
+
+_ELEMENT_TYPES = {
+    "MET_CHAR": np.int8,
+    "MET_UCHAR": np.uint8,
+    "MET_SHORT": np.int16,
+    "MET_USHORT": np.uint16,
+    "MET_INT": np.int32,
+    "MET_UINT": np.uint32,
+    "MET_LONG": np.int32,
+    "MET_ULONG": np.uint32,
+    "MET_LONG_LONG": np.int64,
+    "MET_ULONG_LONG": np.uint64,
+    "MET_FLOAT": np.float32,
+    "MET_DOUBLE": np.float64,
+}
+
+
+def read_mha_header(path):
+    """
+    Args:
+        path (str): path of a .mha or .mhd file.
+
+    Returns:
+        header (dict): the header fields, keyed by name, as strings.
+        data_offset (int): byte offset of the pixel data in the .mha file.
+    """
+    header = {}
+    with open(path, "rb") as f:
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            key, sep, value = line.decode("latin-1").partition("=")
+            if not sep:
+                continue
+            header[key.strip()] = value.strip()
+            # ElementDataFile is always the last header field
+            if key.strip() == "ElementDataFile":
+                break
+        data_offset = f.tell()
+    return header, data_offset
+
+
+class MhaSliceReader:
+    """
+    Iterate over the 2D images of a MetaImage stack without loading the whole stack.
+
+    Slices are taken along `axis` of the array as :func:`SimpleITK.GetArrayFromImage`
+    would return it, i.e. with the dimensions in reversed (z, y, x) order and the
+    channels last. Each slice is copied into a regular, writable array.
+
+    When the slice axis is not the slowest-varying one, the slices are interleaved in
+    the file. They are then gathered a chunk of slices at a time: the data block is read
+    sequentially in row blocks of at most 16 MB, and the part of each block that belongs
+    to the chunk is transposed into it. The chunk is bounded by `chunk_bytes`, and the
+    whole data block is read once per chunk (:attr:`num_passes` times in total), so
+    `chunk_bytes` trades memory against I/O. For the DENTEX test stack (250 RGB slices
+    of 1316 x 2744, a 2.7 GB data block, slice axis 2), iterating over all slices
+    measured:
+
+    ===========  ======  ==========  ==============
+    chunk_bytes  passes  bytes read  peak RSS added
+    ===========  ======  ==========  ==============
+    128 MB       21      57 GB       160 MB
+    512 MB       6       16 GB       542 MB
+    1 GB         3       8.1 GB      1049 MB
+    ===========  ======  ==========  ==============
+    """
+
+    def __init__(self, path, axis=0, chunk_bytes=1 << 27):
+        """
+        Args:
+            path (str): path of a .mha or .mhd file.
+            axis (int): the array axis to iterate over.
+            chunk_bytes (int): memory budget of the slices gathered at once.
+        """
+        self.path = path
+        self.axis = axis
+        self.chunk_bytes = chunk_bytes
+        header, data_offset = read_mha_header(path)
+        self.header = header
+
+        self.shape = None
+        self.dtype = None
+        self.data_file = None
+        self.data_offset = 0
+        if self._is_mappable(header):
+            self._setup_mapping(header, data_offset)
+
+    @staticmethod
+    def _is_mappable(header):
+        if header.get("CompressedData", "False").lower() == "true":
+            return False
+        if header.get("ElementType") not in _ELEMENT_TYPES:
+            return False
+        data_file = header.get("ElementDataFile", "")
+        # "LIST" and file patterns split the data over several files
+        return data_file != "" and data_file != "LIST" and " " not in data_file and "%" not in data_file
+
+    def _setup_mapping(self, header, data_offset):
+        dim_size = [int(d) for d in header["DimSize"].split()]
+        channels = int(header.get("ElementNumberOfChannels", 1))
+        shape = tuple(reversed(dim_size))
+        if channels > 1:
+            shape = shape + (channels,)
+
+        dtype = np.dtype(_ELEMENT_TYPES[header["ElementType"]])
+        msb = header.get("BinaryDataByteOrderMSB", header.get("ElementByteOrderMSB", "False"))
+        dtype = dtype.newbyteorder(">" if msb.lower() == "true" else "<")
+
+        if header["ElementDataFile"] == "LOCAL":
+            data_file = self.path
+        else:
+            data_file = os.path.join(os.path.dirname(self.path), header["ElementDataFile"])
+            data_offset = int(header.get("HeaderSize", 0))
+            if data_offset == -1:
+                # the data is at the end of the file
+                data_offset = os.path.getsize(data_file) - int(np.prod(shape)) * dtype.itemsize
+
+        self.shape = shape
+        self.dtype = dtype
+        self.data_file = data_file
+        self.data_offset = data_offset
+
+    @property
+    def num_passes(self):
+        """Number of times iterating over the slices reads the whole data block."""
+        if self.shape is None or self.axis == 0:
+            return 1
+        return -(-len(self) // self._slices_per_chunk())
+
+    def _slices_per_chunk(self):
+        slice_shape = self.shape[:self.axis] + self.shape[self.axis + 1:]
+        slice_bytes = int(np.prod(slice_shape)) * self.dtype.itemsize
+        return max(self.chunk_bytes // max(slice_bytes, 1), 1)
+
+    def __len__(self):
+        if self.shape is None:
+            return int(self.header["DimSize"].split()[::-1][self.axis])
+        return self.shape[self.axis]
+
+    def __iter__(self):
+        if self.shape is None:
+            yield from self._iter_decoded()
+            return
+        native_dtype = self.dtype.newbyteorder("=")
+        row_shape = self.shape[1:]
+        row_bytes = max(int(np.prod(row_shape)) * self.dtype.itemsize, 1)
+        with open(self.data_file, "rb") as f:
+            if self.axis == 0:
+                # the slices are contiguous rows of the data block
+                f.seek(self.data_offset)
+                for _ in range(len(self)):
+                    yield self._read(f, row_shape).astype(native_dtype)
+                return
+
+            slice_shape = self.shape[:self.axis] + self.shape[self.axis + 1:]
+            slices_per_chunk = self._slices_per_chunk()
+            rows_per_block = max(min(self.chunk_bytes, _ROW_BLOCK_BYTES) // row_bytes, 1)
+            num_rows = self.shape[0]
+            for k0 in range(0, len(self), slices_per_chunk):
+                k1 = min(k0 + slices_per_chunk, len(self))
+                index = (slice(None),) * self.axis + (slice(k0, k1),)
+                # the chunk holds its slices first: (k1 - k0, rows, ...)
+                chunk = np.empty((k1 - k0,) + slice_shape, dtype=native_dtype)
+                f.seek(self.data_offset)
+                for r0 in range(0, num_rows, rows_per_block):
+                    r1 = min(r0 + rows_per_block, num_rows)
+                    block = self._read(f, (r1 - r0,) + row_shape)
+                    chunk[:, r0:r1] = np.moveaxis(block[index], self.axis, 0)
+                    del block
+                # index instead of iterating, so that no view keeps the chunk alive
+                # while the next one is allocated
+                for j in range(k1 - k0):
+                    yield chunk[j].copy()
+                del chunk
+
+    def _read(self, f, shape):
+        count = int(np.prod(shape))
+        data = np.fromfile(f, dtype=self.dtype, count=count)
+        if data.size != count:
+            raise IOError("Unexpected end of the pixel data in {}".format(self.data_file))
+        return data.reshape(shape)
+
+    def _iter_decoded(self):
+        import SimpleITK as sitk
+
+        image_array = sitk.GetArrayFromImage(sitk.ReadImage(self.path))
+        for k in range(image_array.shape[self.axis]):
+            yield np.take(image_array, k, axis=self.axis)
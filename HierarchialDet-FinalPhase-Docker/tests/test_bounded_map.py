@@ -0,0 +1,54 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from hierarchialdet.predictor import _bounded_map
+
+
+class TestBoundedMap(unittest.TestCase):
+    def setUp(self):
+        self.pool = ThreadPoolExecutor(2)
+        self.addCleanup(self.pool.shutdown)
+
+    def _producer_threads(self):
+        return {t for t in threading.enumerate() if t.daemon and not t.name.startswith("ThreadPoolExecutor")}
+
+    def test_results_in_order(self):
+        self.assertEqual(list(_bounded_map(lambda x: x * x, range(20), self.pool, 3)), [x * x for x in range(20)])
+
+    def test_error_is_raised_in_order(self):
+        def items():
+            yield 1
+            yield 2
+            raise RuntimeError("read failed")
+
+        results = _bounded_map(lambda x: x, items(), self.pool, 3)
+        self.assertEqual([next(results), next(results)], [1, 2])
+        with self.assertRaisesRegex(RuntimeError, "read failed"):
+            next(results)
+
+    def test_early_stop_releases_the_producer(self):
+        closed = threading.Event()
+        read = []
+
+        def items():
+            try:
+                for k in range(1000):
+                    read.append(k)
+                    yield k
+            finally:
+                closed.set()
+
+        threads = self._producer_threads()
+        results = _bounded_map(lambda x: x, items(), self.pool, 2)
+        self.assertEqual(next(results), 0)
+        time.sleep(0.2)  # let the producer fill the queue and block on it
+        results.close()
+        self.assertTrue(closed.is_set())
+        self.assertLess(len(read), 10)
+        self.assertEqual(self._producer_threads() - threads, set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+import torch
+from detectron2.config import get_cfg
+
+from hierarchialdet import add_diffusiondet_config
+from hierarchialdet.head import DynamicConv
+
+
+def _dynamic_conv(chunk_size):
+    cfg = get_cfg()
+    add_diffusiondet_config(cfg)
+    cfg.MODEL.ROI_BOX_HEAD.POOLER_RESOLUTION = 7  # as in configs/Base-DiffusionDet.yaml
+    cfg.MODEL.DiffusionDet.DYNAMIC_CONV_CHUNK_SIZE = chunk_size
+    torch.manual_seed(0)
+    return DynamicConv(cfg).eval()
+
+
+class TestDynamicConvChunks(unittest.TestCase):
+    def setUp(self):
+        self.full = _dynamic_conv(0)
+        self.chunked = _dynamic_conv(64)
+        self.chunked.load_state_dict(self.full.state_dict())
+
+    def _inputs(self, num_boxes):
+        return torch.randn(1, num_boxes, 256), torch.randn(49, num_boxes, 256)
+
+    def test_chunked_matches_unchunked(self):
+        for num_boxes in (200, 64, 10):  # a partial last chunk, one whole chunk, fewer boxes than a chunk
+            pro_features, roi_features = self._inputs(num_boxes)
+            with torch.no_grad():
+                expected = self.full(pro_features, roi_features)
+                output = self.chunked(pro_features, roi_features)
+            torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-5)
+
+    def test_workspace_is_reused(self):
+        with torch.no_grad():
+            self.chunked(*self._inputs(200))
+            buffers = {name: buffer.data_ptr() for name, buffer in self.chunked.workspace.items()}
+            self.assertEqual(self.chunked.workspace["parameters"].numel(), 64 * 2 * 256 * 64)
+            self.chunked(*self._inputs(150))
+        self.assertEqual({name: buffer.data_ptr() for name, buffer in self.chunked.workspace.items()}, buffers)
+
+    def test_grad_enabled_takes_the_unchunked_path(self):
+        pro_features, roi_features = self._inputs(100)
+        self.chunked(pro_features, roi_features).sum().backward()
+        self.assertEqual(self.chunked.workspace, {})
+        self.assertIsNotNone(self.chunked.dynamic_layer.weight.grad)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from hierarchialdet.util.mha import MhaSliceReader
+
+
+def _write_mha(directory, array, channels=1, big_endian=False, detached=False):
+    """Write `array`, in SimpleITK's (z, y, x[, c]) order, as a MetaImage file."""
+    dim_size = array.shape[:3] if channels > 1 else array.shape
+    dtype = array.dtype.newbyteorder(">" if big_endian else "<")
+    header = [
+        "ObjectType = Image",
+        "NDims = {}".format(len(dim_size)),
+        "BinaryData = True",
+        "BinaryDataByteOrderMSB = {}".format(big_endian),
+        "CompressedData = False",
+        "DimSize = {}".format(" ".join(str(d) for d in reversed(dim_size))),
+        "ElementNumberOfChannels = {}".format(channels),
+        "ElementType = {}".format({np.uint8: "MET_UCHAR", np.int16: "MET_SHORT"}[array.dtype.type]),
+    ]
+    data = array.astype(dtype).tobytes()
+    if detached:
+        path = os.path.join(directory, "stack.mhd")
+        header.append("ElementDataFile = stack.raw")
+        with open(os.path.join(directory, "stack.raw"), "wb") as f:
+            f.write(data)
+        with open(path, "w") as f:
+            f.write("\n".join(header) + "\n")
+    else:
+        path = os.path.join(directory, "stack.mha")
+        header.append("ElementDataFile = LOCAL")
+        with open(path, "wb") as f:
+            f.write(("\n".join(header) + "\n").encode("latin-1") + data)
+    return path
+
+
+class TestMhaSliceReader(unittest.TestCase):
+    def _check(self, array, channels=1, big_endian=False, detached=False):
+        with tempfile.TemporaryDirectory() as directory:
+            path = _write_mha(directory, array, channels, big_endian, detached)
+            for axis in range(3):
+                # budgets that fit everything, and that force several chunks and row blocks
+                for chunk_bytes in (1 << 27, array[0].nbytes * 2, 1):
+                    reader = MhaSliceReader(path, axis=axis, chunk_bytes=chunk_bytes)
+                    slices = list(reader)
+                    self.assertEqual(len(slices), len(reader))
+                    if axis == 0 or chunk_bytes == 1:
+                        self.assertEqual(reader.num_passes, 1 if axis == 0 else len(reader))
+                    for k, image in enumerate(slices):
+                        np.testing.assert_array_equal(image, np.take(array, k, axis=axis))
+                        self.assertTrue(image.flags.writeable and image.flags.c_contiguous)
+                        self.assertTrue(image.dtype.isnative)
+
+    def test_grayscale(self):
+        self._check(np.random.RandomState(0).randint(-500, 500, size=(7, 11, 13)).astype(np.int16))
+
+    def test_big_endian(self):
+        self._check(np.random.RandomState(1).randint(-500, 500, size=(5, 6, 9)).astype(np.int16), big_endian=True)
+
+    def test_channels(self):
+        self._check(np.random.RandomState(2).randint(0, 255, size=(6, 9, 5, 3)).astype(np.uint8), channels=3)
+
+    def test_detached_data_file(self):
+        self._check(np.random.RandomState(3).randint(0, 255, size=(4, 8, 10)).astype(np.uint8), detached=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+import torch
+from detectron2.config import get_cfg
+from detectron2.layers import ShapeSpec
+
+from hierarchialdet import add_diffusiondet_config
+from hierarchialdet.head import DynamicHead, RCNNHead
+
+
+def _three_tower_logits(head, fc_feature):
+    """The classification of RCNNHead before the tower was shared: one tower per level."""
+    cls_feature_1 = fc_feature.clone()
+    cls_feature_2 = fc_feature.clone()
+    cls_feature_3 = fc_feature.clone()
+    for cls_layer in head.cls_module:
+        cls_feature_1 = cls_layer(cls_feature_1)
+        cls_feature_2 = cls_layer(cls_feature_2)
+        cls_feature_3 = cls_layer(cls_feature_3)
+    return (
+        head.class_logits_quadrant(cls_feature_1),
+        head.class_logits_enumeration(cls_feature_2),
+        head.class_logits_disease(cls_feature_3),
+    )
+
+
+class TestRCNNHeadSharedTower(unittest.TestCase):
+    def test_checkpoint_logits_match(self):
+        cfg = get_cfg()
+        add_diffusiondet_config(cfg)
+        cfg.MODEL.ROI_HEADS.IN_FEATURES = ["p2", "p3"]
+        cfg.MODEL.DiffusionDet.NUM_CLS = 2
+        input_shape = {"p2": ShapeSpec(channels=256, stride=4), "p3": ShapeSpec(channels=256, stride=8)}
+        pooler = DynamicHead._init_box_pooler(cfg, input_shape)
+
+        torch.manual_seed(0)
+        state_dict = RCNNHead(cfg, 256, cfg.MODEL.DiffusionDet.NUM_CLASSES).state_dict()
+        torch.manual_seed(1)
+        head = RCNNHead(cfg, 256, cfg.MODEL.DiffusionDet.NUM_CLASSES)
+        head.load_state_dict(state_dict, strict=True)
+        head.eval()
+
+        fc_features = []
+        head.cls_module[0].register_forward_pre_hook(lambda m, inputs: fc_features.append(inputs[0].clone()))
+
+        N, nr_boxes = 2, 10
+        features = [torch.randn(N, 256, 32, 32), torch.randn(N, 256, 16, 16)]
+        xy = torch.rand(N, nr_boxes, 2) * 90
+        bboxes = torch.cat([xy, xy + 8 + torch.rand(N, nr_boxes, 2) * 30], dim=-1)
+        scale_shift = torch.randn(N, 512)
+        with torch.no_grad():
+            outputs = head(features, bboxes, None, pooler, scale_shift, False, False, False)
+            expected = _three_tower_logits(head, fc_features[0])
+
+        for name, logits, reference in zip(("quadrant", "enumeration", "disease"), outputs[:3], expected):
+            self.assertTrue(torch.equal(logits, reference.view(N, nr_boxes, -1)), name)
+
+
+if __name__ == "__main__":
+    unittest.main()
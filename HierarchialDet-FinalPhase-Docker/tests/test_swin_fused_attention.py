@@ -0,0 +1,76 @@
+import unittest
+
+import torch
+import torch.nn.functional as F
+
+from hierarchialdet.swintransformer import SwinTransformer, WindowAttention, shifted_window_attention_mask
+
+HAS_SDPA = hasattr(F, "scaled_dot_product_attention")
+
+
+def _attention_pair(qk_scale=None):
+    torch.manual_seed(0)
+    explicit = WindowAttention(64, (7, 7), 4, qk_scale=qk_scale).eval()
+    fused = WindowAttention(64, (7, 7), 4, qk_scale=qk_scale, fused_attn=True).eval()
+    fused.load_state_dict(explicit.state_dict())
+    return explicit, fused
+
+
+@unittest.skipIf(not HAS_SDPA, "F.scaled_dot_product_attention is not available")
+class TestSwinFusedAttention(unittest.TestCase):
+    def test_window_attention_without_mask(self):
+        explicit, fused = _attention_pair()
+        x = torch.randn(6, 49, 64)
+        with torch.no_grad():
+            torch.testing.assert_close(fused(x), explicit(x), rtol=1e-5, atol=1e-5)
+
+    def test_window_attention_with_shift_mask(self):
+        explicit, fused = _attention_pair()
+        mask = shifted_window_attention_mask(14, 21, 7, 3, torch.device("cpu"))  # 6 windows
+        for batch_size in (1, 3):
+            x = torch.randn(batch_size * mask.shape[0], 49, 64)
+            with torch.no_grad():
+                torch.testing.assert_close(fused(x, mask), explicit(x, mask), rtol=1e-5, atol=1e-5)
+
+    def test_window_attention_custom_qk_scale(self):
+        explicit, fused = _attention_pair(qk_scale=0.05)
+        x = torch.randn(4, 49, 64)
+        with torch.no_grad():
+            torch.testing.assert_close(fused(x), explicit(x), rtol=1e-5, atol=1e-5)
+
+    def test_window_attention_gradients(self):
+        explicit, fused = _attention_pair()
+        explicit.train()
+        fused.train()
+        mask = shifted_window_attention_mask(14, 14, 7, 3, torch.device("cpu"))
+        x = torch.randn(2 * mask.shape[0], 49, 64)
+        explicit(x, mask).square().sum().backward()
+        fused(x, mask).square().sum().backward()
+        for (name, p_explicit), p_fused in zip(explicit.named_parameters(), fused.parameters()):
+            torch.testing.assert_close(p_fused.grad, p_explicit.grad, rtol=1e-4, atol=1e-5, msg=name)
+
+    def test_backbone(self):
+        torch.manual_seed(0)
+        kwargs = dict(embed_dim=32, depths=[2, 2], num_heads=[2, 4], out_indices=(0, 1), drop_path_rate=0.)
+        explicit = SwinTransformer(**kwargs)
+        fused = SwinTransformer(fused_attn=True, **kwargs)
+        fused.load_state_dict(explicit.state_dict())
+        explicit.eval()
+        fused.eval()
+        x = torch.randn(2, 3, 100, 132)  # padded to whole windows, shifted in the second block
+        with torch.no_grad():
+            out_explicit, out_fused = explicit(x), fused(x)
+        for k in out_explicit:
+            torch.testing.assert_close(out_fused[k], out_explicit[k], rtol=1e-4, atol=1e-4)
+
+
+@unittest.skipIf(HAS_SDPA, "F.scaled_dot_product_attention is available")
+class TestSwinFusedAttentionUnavailable(unittest.TestCase):
+    def test_warns_and_falls_back(self):
+        with self.assertLogs("hierarchialdet.swintransformer", level="WARNING"):
+            model = SwinTransformer(embed_dim=32, depths=[2], num_heads=[2], out_indices=(0,), fused_attn=True)
+        self.assertFalse(any(m.fused_attn for m in model.modules() if isinstance(m, WindowAttention)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+
+import torch
+
+from hierarchialdet.swintransformer import SwinTransformer, shifted_window_attention_mask
+
+
+class TestSwinMaskCache(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = SwinTransformer(embed_dim=32, depths=[2, 2], num_heads=[2, 4], out_indices=(0, 1))
+        self.model.eval()
+        shifted_window_attention_mask.cache_clear()
+        self.addCleanup(shifted_window_attention_mask.cache_clear)
+
+    def test_masks_are_reused_across_forwards(self):
+        x = torch.randn(1, 3, 100, 132)
+        with torch.no_grad():
+            first = self.model(x)
+            info = shifted_window_attention_mask.cache_info()
+            self.assertEqual((info.hits, info.misses), (0, 2))  # one mask per stage
+
+            second = self.model(x)
+            info = shifted_window_attention_mask.cache_info()
+            self.assertEqual((info.hits, info.misses), (2, 2))
+
+            self.model(torch.randn(1, 3, 164, 132))  # a new size builds new masks
+            info = shifted_window_attention_mask.cache_info()
+            self.assertEqual((info.hits, info.misses), (2, 4))
+        for k in first:
+            self.assertTrue(torch.equal(first[k], second[k]))
+
+    def test_cached_mask_matches_a_fresh_build(self):
+        device = torch.device("cpu")
+        cached = shifted_window_attention_mask(28, 35, 7, 3, device)
+        self.assertIs(shifted_window_attention_mask(28, 35, 7, 3, device), cached)
+        self.assertTrue(torch.equal(cached, shifted_window_attention_mask.__wrapped__(28, 35, 7, 3, device)))
+
+    def test_mask_built_in_inference_mode_is_usable_for_training(self):
+        with torch.inference_mode():
+            self.model(torch.randn(1, 3, 100, 132))
+        self.model.train()
+        out = self.model(torch.randn(1, 3, 100, 132))
+        sum(o.sum() for o in out.values()).backward()
+        self.assertEqual(shifted_window_attention_mask.cache_info().hits, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
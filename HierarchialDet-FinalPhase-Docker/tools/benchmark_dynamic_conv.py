@@ -0,0 +1,97 @@
+"""
+Time and peak memory of DynamicConv over the six head stages, with and without
+MODEL.DiffusionDet.DYNAMIC_CONV_CHUNK_SIZE.
+
+On CUDA the peak is the allocator's peak. On the CPU it is the growth of the peak RSS
+of this process. That peak only increases, so the variants run from the smallest
+expected peak (chunked) to the largest, and each reading is an upper bound.
+
+Example:
+    python tools/benchmark_dynamic_conv.py --num-proposals 1000 --chunk-size 128 --device cpu
+"""
+import argparse
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from detectron2.config import get_cfg  # noqa: E402
+from hierarchialdet import add_diffusiondet_config  # noqa: E402
+from hierarchialdet.head import DynamicConv  # noqa: E402
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark chunked DynamicConv")
+    parser.add_argument(
+        "--config-file",
+        default=os.path.join(os.path.dirname(__file__), "..", "configs", "diffdet.custom.swinbase.nonpretrain.yaml"),
+    )
+    parser.add_argument("--num-proposals", type=int, default=1000, help="proposals of all images of a batch")
+    parser.add_argument("--chunk-size", type=int, default=128)
+    parser.add_argument("--iters", type=int, default=3, help="timed forwards of the six stages")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser
+
+
+def _peak_bytes(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _run(cfg, state_dict, args, device):
+    module = DynamicConv(cfg).to(device).eval()
+    module.load_state_dict(state_dict)
+    generator = torch.Generator().manual_seed(0)
+    pro_features = torch.randn(1, args.num_proposals, cfg.MODEL.DiffusionDet.HIDDEN_DIM, generator=generator)
+    resolution = cfg.MODEL.ROI_BOX_HEAD.POOLER_RESOLUTION ** 2
+    roi_features = torch.randn(resolution, args.num_proposals, cfg.MODEL.DiffusionDet.HIDDEN_DIM, generator=generator)
+    pro_features, roi_features = pro_features.to(device), roi_features.to(device)
+    num_stages = cfg.MODEL.DiffusionDet.NUM_HEADS
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+    start_bytes = _peak_bytes(device)
+    times = []
+    with torch.no_grad():
+        for _ in range(args.iters):
+            start = time.perf_counter()
+            for _ in range(num_stages):
+                output = module(pro_features, roi_features)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - start)
+    return output.cpu(), np.median(times) * 1000, (_peak_bytes(device) - start_bytes) / 2 ** 20
+
+
+def main():
+    args = get_parser().parse_args()
+    cfg = get_cfg()
+    add_diffusiondet_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    device = torch.device(args.device)
+
+    torch.manual_seed(0)
+    state_dict = DynamicConv(cfg).state_dict()
+    results = {}
+    for chunk_size in (args.chunk_size, 0):
+        cfg.MODEL.DiffusionDet.DYNAMIC_CONV_CHUNK_SIZE = chunk_size
+        results[chunk_size] = _run(cfg, state_dict, args, device)
+
+    print("{} proposals, {} stages, {} runs on {}".format(
+        args.num_proposals, cfg.MODEL.DiffusionDet.NUM_HEADS, args.iters, args.device))
+    for chunk_size, (_, milliseconds, peak_mb) in sorted(results.items()):
+        print("  chunk size {:<5} {:9.1f} ms  peak memory +{:7.1f} MB".format(
+            chunk_size or "off", milliseconds, peak_mb))
+    difference = (results[args.chunk_size][0] - results[0][0]).abs().max().item()
+    print("  max abs difference of the outputs: {:.3g}".format(difference))
+
+
+if __name__ == "__main__":
+    main()
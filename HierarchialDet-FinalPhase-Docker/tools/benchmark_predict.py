@@ -0,0 +1,78 @@
+"""
+Per-image time of VisualizationDemo.run_on_image and of the headless
+VisualizationDemo.predict on one random panoramic-sized image.
+
+Example:
+    python tools/benchmark_predict.py --iters 20 --opts MODEL.DEVICE cpu MODEL.SWIN.SIZE T
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from detectron2.config import get_cfg  # noqa: E402
+from hierarchialdet import add_diffusiondet_config  # noqa: E402
+from hierarchialdet.predictor import VisualizationDemo  # noqa: E402
+from hierarchialdet.util.model_ema import add_model_ema_configs  # noqa: E402
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark VisualizationDemo.predict against run_on_image")
+    parser.add_argument(
+        "--config-file",
+        default=os.path.join(os.path.dirname(__file__), "..", "configs", "diffdet.custom.swinbase.nonpretrain.yaml"),
+    )
+    parser.add_argument("--height", type=int, default=1316)
+    parser.add_argument("--width", type=int, default=2900)
+    parser.add_argument("--iters", type=int, default=10, help="timed runs of each path")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--opts", default=[], nargs=argparse.REMAINDER, help="config overrides, KEY VALUE pairs")
+    return parser
+
+
+def _time(fn, image):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    fn(image)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def main():
+    args = get_parser().parse_args()
+    cfg = get_cfg()
+    add_diffusiondet_config(cfg)
+    add_model_ema_configs(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.MODEL.WEIGHTS = ""  # random weights: only the time is measured
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+
+    demo = VisualizationDemo(cfg, k=2)
+    image = np.random.RandomState(0).randint(0, 256, size=(args.height, args.width, 3)).astype(np.uint8)
+
+    for _ in range(args.warmup):
+        demo.run_on_image(image)
+        demo.predict(image)
+    # alternate the two paths so that drifts affect both alike
+    times = {"run_on_image": [], "predict": []}
+    for _ in range(args.iters):
+        times["run_on_image"].append(_time(demo.run_on_image, image))
+        times["predict"].append(_time(demo.predict, image))
+
+    medians = {name: np.median(t) * 1000 for name, t in times.items()}
+    print("image {}x{}, {} runs each".format(args.height, args.width, args.iters))
+    for name, median in medians.items():
+        print("  {:<13} {:9.1f} ms".format(name, median))
+    print("  saving        {:9.1f} ms per image".format(medians["run_on_image"] - medians["predict"]))
+
+
+if __name__ == "__main__":
+    main()
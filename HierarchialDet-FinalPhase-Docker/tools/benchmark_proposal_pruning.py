@@ -0,0 +1,128 @@
+"""
+Per-image time of VisualizationDemo.predict with progressive proposal pruning
+(MODEL.DiffusionDet.PRUNE_STAGES / PRUNE_NUM_PROPOSALS) against no pruning, and how
+many of the unpruned detections each setting keeps.
+
+A detection is kept if the pruned run has one of the same class at IoU >= 0.5. With
+random weights this only checks the plumbing; pass trained weights with
+`--opts MODEL.WEIGHTS ...` for a meaningful figure. The AP itself needs the evaluator
+on labelled data.
+
+Example:
+    python tools/benchmark_proposal_pruning.py --prune 1:300,3:100 --prune 1:500 \
+        --opts MODEL.DEVICE cpu MODEL.SWIN.SIZE T
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from detectron2.config import get_cfg  # noqa: E402
+from detectron2.structures import pairwise_iou  # noqa: E402
+from hierarchialdet import add_diffusiondet_config  # noqa: E402
+from hierarchialdet.predictor import VisualizationDemo  # noqa: E402
+from hierarchialdet.util.model_ema import add_model_ema_configs  # noqa: E402
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark progressive proposal pruning")
+    parser.add_argument(
+        "--config-file",
+        default=os.path.join(os.path.dirname(__file__), "..", "configs", "diffdet.custom.swinbase.nonpretrain.yaml"),
+    )
+    parser.add_argument(
+        "--prune",
+        action="append",
+        default=[],
+        help="a pruning setting as STAGE:NUM_PROPOSALS pairs, e.g. 1:300,3:100; may be repeated",
+    )
+    parser.add_argument("--k", type=int, default=2, help="hierarchy level that is predicted")
+    parser.add_argument("--height", type=int, default=1316)
+    parser.add_argument("--width", type=int, default=2900)
+    parser.add_argument("--top", type=int, default=100, help="number of unpruned detections that are compared")
+    parser.add_argument("--iters", type=int, default=5, help="timed runs of each setting")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--opts", default=[], nargs=argparse.REMAINDER, help="config overrides, KEY VALUE pairs")
+    return parser
+
+
+def _parse_prune(setting):
+    pairs = [pair.split(":") for pair in setting.split(",")]
+    return [int(stage) for stage, _ in pairs], [int(num) for _, num in pairs]
+
+
+def _build_demo(args, prune_stages, prune_num_proposals):
+    cfg = get_cfg()
+    add_diffusiondet_config(cfg)
+    add_model_ema_configs(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.MODEL.WEIGHTS = ""  # random weights unless overridden in --opts
+    cfg.MODEL.DiffusionDet.NOISE_SEED = 0  # the same sampling noise for every setting
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.0  # as process.py, which keeps every detection
+    cfg.merge_from_list(args.opts)
+    cfg.MODEL.DiffusionDet.PRUNE_STAGES = prune_stages
+    cfg.MODEL.DiffusionDet.PRUNE_NUM_PROPOSALS = prune_num_proposals
+    cfg.freeze()
+    torch.manual_seed(0)  # the same random weights for every setting
+    demo = VisualizationDemo(cfg, k=args.k)
+    if not cfg.MODEL.WEIGHTS:
+        # random box regressors move every box out of the image; keep them near the proposals
+        with torch.no_grad():
+            for head in demo.predictor.model.head.head_series:
+                head.bboxes_delta.weight.normal_(std=1e-3)
+                head.bboxes_delta.bias.zero_()
+    return demo
+
+
+def _time(fn, image):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    result = fn(image)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - start, result
+
+
+def _kept(reference, instances, k):
+    """Fraction of `reference` matched by a detection of the same class in `instances`."""
+    if len(reference) == 0:
+        return 1.
+    classes = "pred_classes_{}".format(k + 1)
+    iou = pairwise_iou(reference.pred_boxes, instances.pred_boxes)
+    same_class = getattr(reference, classes)[:, None] == getattr(instances, classes)[None, :]
+    return ((iou >= 0.5) & same_class).any(dim=1).float().mean().item()
+
+
+def main():
+    args = get_parser().parse_args()
+    settings = [("off", [], [])] + [(setting,) + _parse_prune(setting) for setting in args.prune]
+    image = np.random.RandomState(0).randint(0, 256, size=(args.height, args.width, 3)).astype(np.uint8)
+
+    results = []
+    for name, prune_stages, prune_num_proposals in settings:
+        demo = _build_demo(args, prune_stages, prune_num_proposals)
+        for _ in range(args.warmup):
+            demo.predict(image)
+        times = []
+        for _ in range(args.iters):
+            seconds, instances = _time(demo.predict, image)
+            times.append(seconds)
+        results.append((name, np.median(times) * 1000, instances.to("cpu")))
+        del demo
+
+    reference = results[0][2]
+    reference = reference[reference.scores.argsort(descending=True)[:args.top]]
+    print("image {}x{}, k={}, {} runs each".format(args.height, args.width, args.k, args.iters))
+    for name, milliseconds, instances in results:
+        print("  pruning {:<16} {:9.1f} ms  {:4.2f}x  keeps {:6.1%} of the top {} unpruned detections".format(
+            name, milliseconds, results[0][1] / milliseconds, _kept(reference, instances, args.k), len(reference)))
+
+
+if __name__ == "__main__":
+    main()
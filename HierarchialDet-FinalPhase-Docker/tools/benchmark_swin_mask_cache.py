@@ -0,0 +1,100 @@
+"""
+Swin backbone forward time with the shifted-window attention masks cached, against
+rebuilding them on every forward as before, plus the cache hit rate.
+
+Example:
+    python tools/benchmark_swin_mask_cache.py --size T --iters 10 --device cpu
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from hierarchialdet.swintransformer import SwinTransformer, shifted_window_attention_mask, size2config  # noqa: E402
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the Swin shifted-window mask cache")
+    parser.add_argument("--size", default="L-22k", choices=sorted(size2config))
+    # a 1316 x 2744 panoramic after the default test resize
+    parser.add_argument("--height", type=int, default=640)
+    parser.add_argument("--width", type=int, default=1333)
+    parser.add_argument("--iters", type=int, default=10, help="timed forwards of each variant")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser
+
+
+def _time(fn):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def main():
+    args = get_parser().parse_args()
+    config = size2config[args.size]
+    model = SwinTransformer(
+        embed_dim=config["embed_dim"],
+        window_size=config["window_size"],
+        depths=config["depth"],
+        num_heads=config["num_heads"],
+        out_indices=(0, 1, 2, 3),
+    ).to(args.device)
+    model.eval()
+    x = torch.randn(1, 3, args.height, args.width, device=args.device)
+
+    def cached():
+        model(x)
+
+    def uncached():
+        shifted_window_attention_mask.cache_clear()
+        model(x)
+
+    def build_masks():
+        # the mask of every stage, built without the cache
+        H, W = (args.height + 3) // 4, (args.width + 3) // 4
+        window_size = config["window_size"]
+        for _ in config["depth"]:
+            Hp = int(np.ceil(H / window_size)) * window_size
+            Wp = int(np.ceil(W / window_size)) * window_size
+            shifted_window_attention_mask.__wrapped__(Hp, Wp, window_size, window_size // 2, x.device)
+            H, W = (H + 1) // 2, (W + 1) // 2
+
+    with torch.no_grad():
+        for _ in range(args.warmup):
+            uncached()
+            cached()
+        shifted_window_attention_mask.cache_clear()
+        # alternate the two variants so that drifts affect both alike
+        times = {"uncached": [], "cached": [], "mask build": []}
+        for _ in range(args.iters):
+            times["uncached"].append(_time(uncached))
+            times["cached"].append(_time(cached))
+            times["mask build"].append(_time(build_masks))
+
+        shifted_window_attention_mask.cache_clear()
+        for _ in range(args.iters):
+            cached()
+        info = shifted_window_attention_mask.cache_info()
+
+    medians = {name: np.median(t) * 1000 for name, t in times.items()}
+    print("Swin-{} input {}x{} on {}, {} runs each".format(args.size, args.height, args.width, args.device, args.iters))
+    for name, median in medians.items():
+        print("  {:<13} {:9.1f} ms".format(name, median))
+    print("  saving        {:9.1f} ms per forward".format(medians["uncached"] - medians["cached"]))
+    print("  cache over {} forwards: {} hits, {} misses, hit rate {:.1%}".format(
+        args.iters, info.hits, info.misses, info.hits / (info.hits + info.misses)))
+
+
+if __name__ == "__main__":
+    main()